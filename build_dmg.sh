@@ -42,6 +42,11 @@ fi
 echo "[1/7] Syncing latest source into app bundle..."
 cp -f viewer.py "${APP_BUNDLE}/Contents/Resources/viewer.py"
 cp -f markdown_parser.py "${APP_BUNDLE}/Contents/Resources/markdown_parser.py"
+cp -f markdown_loader.py "${APP_BUNDLE}/Contents/Resources/markdown_loader.py"
+cp -f search_index.py "${APP_BUNDLE}/Contents/Resources/search_index.py"
+cp -f link_checker.py "${APP_BUNDLE}/Contents/Resources/link_checker.py"
+cp -f syntax_highlight.py "${APP_BUNDLE}/Contents/Resources/syntax_highlight.py"
+cp -f themes.cfg "${APP_BUNDLE}/Contents/Resources/themes.cfg"
 
 # Make sure the launcher is executable
 chmod +x "${APP_BUNDLE}/Contents/MacOS/MarkdownViewer"
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks the local links and image references in a tree of Markdown files.
+
+Usage: python link_checker.py [--anchors] [--jobs N] folder-or-file ...
+
+Compressed files (.md.gz, .md.bz2) are checked too, and so is every
+Markdown file inside a zip archive that is named or found.
+
+Files are parsed in a process pool where multiprocessing is available.
+Every distinct target is looked up once, with the stat calls spread over
+a pool of threads in batches.  Web links are counted but not fetched.
+"""
+
+import os
+import re
+import sys
+import stat
+import urllib
+import optparse
+import threading
+import Queue
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5: parse in this process
+    multiprocessing = None
+
+from markdown_parser import MarkdownParser
+from markdown_loader import read_markdown, stat_path, is_markdown, \
+    is_archive, walk_archive
+
+
+HEADING_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+SCHEME_PATTERN = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+SLUG_STRIP_PATTERN = re.compile(r'[^\w\- ]', re.UNICODE)
+
+STAT_BATCH = 256
+
+_parser = None
+
+
+def heading_anchor(heading):
+    """Return the GitHub-style anchor for a heading's text."""
+    if isinstance(heading, str):
+        heading = heading.decode('utf-8', 'replace')
+    slug = SLUG_STRIP_PATTERN.sub(u'', heading.strip().lower())
+    return slug.replace(u' ', u'-')
+
+
+def scan_file(path):
+    """Return (path, references, anchors) for one Markdown file.
+
+    references is a list of (line, kind, target) with kind 'link' or
+    'image'; anchors is the list of heading anchors in the file.  Returns
+    None if the file can't be read.  A module-level function so that a
+    process pool can run it.
+    """
+    global _parser
+    if _parser is None:
+        _parser = MarkdownParser()
+    starts = []
+    try:
+        segments = read_markdown(path, _parser, starts)[0]
+    except (IOError, OSError):
+        return None
+
+    references = []
+    anchors = []
+    seen_anchors = {}
+    kind = 'link'
+    for index, (text, tags) in enumerate(segments):
+        if tags and tags[0] in HEADING_TAGS:
+            anchor = heading_anchor(text)
+            count = seen_anchors.get(anchor, 0)
+            seen_anchors[anchor] = count + 1
+            if count:
+                anchor = u'%s-%d' % (anchor, count)
+            anchors.append(anchor)
+        elif 'image_icon' in tags:
+            kind = 'image'
+        elif 'link_url' in tags:
+            references.append((starts[index], kind, text))
+            kind = 'link'
+    return path, references, anchors
+
+
+def find_markdown_files(paths):
+    """Yield the Markdown files named by paths or found below them,
+    including those inside zip archives."""
+    for path in paths:
+        if is_archive(path):
+            for member in walk_archive(path):
+                yield member
+            continue
+        if os.path.isfile(path):
+            yield path
+            continue
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.')]
+            dirnames.sort()
+            filenames.sort()
+            for name in filenames:
+                path = os.path.join(directory, name)
+                if is_markdown(name):
+                    yield path
+                elif is_archive(path):
+                    for member in walk_archive(path):
+                        yield member
+
+
+def scan_files(paths, jobs=None):
+    """Return the scan_file() results for paths, in parallel if possible."""
+    if multiprocessing is None or len(paths) < 2:
+        return [scan_file(path) for path in paths]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(scan_file, paths, 64)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def stat_paths(paths, threads=8):
+    """Return {path: True if it is an existing file, False if missing, or
+    None for a directory}, looking paths up in batches on a thread pool.
+
+    os.stat releases the interpreter lock, so the lookups overlap on
+    network volumes and cold disks.
+    """
+    results = {}
+    batches = Queue.Queue()
+    for start in xrange(0, len(paths), STAT_BATCH):
+        batches.put(paths[start:start + STAT_BATCH])
+
+    def work():
+        found = {}
+        while True:
+            try:
+                batch = batches.get_nowait()
+            except Queue.Empty:
+                break
+            for path in batch:
+                try:
+                    st = stat_path(path)
+                except OSError:
+                    found[path] = False
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    found[path] = None
+                else:
+                    found[path] = True
+        lock.acquire()
+        try:
+            results.update(found)
+        finally:
+            lock.release()
+
+    lock = threading.Lock()
+    workers = [threading.Thread(target=work, name="stat")
+               for i in xrange(min(threads, batches.qsize()))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def split_target(target):
+    """Return (path, fragment) for a link target, or None for targets with
+    a scheme (web links, mail addresses)."""
+    target = target.strip()
+    if isinstance(target, unicode):
+        # %-escapes stand for UTF-8 bytes
+        target = target.encode('utf-8')
+    if target.startswith('<') and target.endswith('>'):
+        target = target[1:-1]
+    else:
+        # Drop an optional "title"
+        target = target.split(' ')[0]
+    if SCHEME_PATTERN.match(target):
+        return None
+    if '#' in target:
+        path, fragment = target.split('#', 1)
+    else:
+        path, fragment = target, None
+    return urllib.unquote(path), fragment
+
+
+class Problem(object):
+    """One broken reference found by the checker."""
+
+    def __init__(self, source, line, message, target):
+        self.source = source
+        self.line = line
+        self.message = message
+        self.target = target
+
+    def __str__(self):
+        target = self.target
+        if isinstance(target, unicode):
+            # Targets come from the decoded file and may be any text;
+            # the source path is printed as its bytes on disk
+            target = target.encode('utf-8')
+        return "%s:%d: %s: %s" % (self.source, self.line, self.message,
+                                  target)
+
+
+class LinkReport(object):
+    """What a check found."""
+
+    def __init__(self):
+        self.files = 0
+        self.references = 0
+        self.external = 0
+        self.targets = 0
+        self.problems = []
+
+
+def check(paths, anchors=False, jobs=None, threads=8):
+    """Check the Markdown files under paths and return a LinkReport."""
+    report = LinkReport()
+    files = list(find_markdown_files(paths))
+    results = [result for result in scan_files(files, jobs)
+               if result is not None]
+    report.files = len(results)
+
+    file_anchors = {}
+    for path, references, heading_anchors in results:
+        file_anchors[os.path.abspath(path)] = heading_anchors
+
+    # Resolve every reference, keeping one entry per distinct target file
+    uses = {}
+    for path, references, heading_anchors in results:
+        base = os.path.dirname(os.path.abspath(path))
+        for line, kind, target in references:
+            report.references += 1
+            split = split_target(target)
+            if split is None:
+                report.external += 1
+                continue
+            target_path, fragment = split
+            if target_path:
+                resolved = os.path.normpath(os.path.join(base, target_path))
+            else:
+                resolved = os.path.abspath(path)
+            uses.setdefault(resolved, []).append(
+                (path, line, kind, target, fragment))
+    report.targets = len(uses)
+
+    found = stat_paths(uses.keys(), threads)
+
+    missing_anchor_files = []
+    for resolved, references in uses.iteritems():
+        exists = found.get(resolved, True)
+        for path, line, kind, target, fragment in references:
+            if exists is False:
+                if kind == 'image':
+                    message = "missing image"
+                else:
+                    message = "broken link"
+                report.problems.append(Problem(path, line, message, target))
+            elif anchors and fragment and exists and is_markdown(resolved):
+                if resolved not in file_anchors:
+                    missing_anchor_files.append(resolved)
+                    file_anchors[resolved] = None
+
+    # Targets outside the checked tree are parsed only for their anchors
+    if missing_anchor_files:
+        for result in scan_files(missing_anchor_files, jobs):
+            if result is not None:
+                file_anchors[result[0]] = result[2]
+
+    if anchors:
+        for resolved, references in uses.iteritems():
+            target_anchors = file_anchors.get(resolved)
+            if target_anchors is None:
+                continue
+            for path, line, kind, target, fragment in references:
+                if not fragment:
+                    continue
+                fragment = urllib.unquote(fragment).decode('utf-8', 'replace')
+                if fragment.lower() not in target_anchors:
+                    report.problems.append(
+                        Problem(path, line, "missing anchor", target))
+
+    report.problems.sort(key=lambda p: (p.source, p.line))
+    return report
+
+
+def main(argv=None):
+    option_parser = optparse.OptionParser(
+        usage="%prog [options] folder-or-file ...")
+    option_parser.add_option('--anchors', action='store_true', default=False,
+                             help="also check #fragments against the "
+                                  "headings of the target file")
+    option_parser.add_option('--jobs', type='int', default=None,
+                             help="parser processes (default: one per CPU)")
+    option_parser.add_option('--threads', type='int', default=8,
+                             help="threads used to look up targets "
+                                  "(default %default)")
+    if argv is None:
+        argv = sys.argv[1:]
+    options, args = option_parser.parse_args(argv)
+    if not args:
+        option_parser.error("no folder or file given")
+
+    return print_report(check(args, anchors=options.anchors,
+                              jobs=options.jobs, threads=options.threads))
+
+
+def print_report(report):
+    """Print report; return the exit status (1 if anything is broken)."""
+    for problem in report.problems:
+        print problem
+    print "%d files, %d references (%d external, not checked), " \
+          "%d distinct targets, %d problems" % (
+              report.files, report.references, report.external,
+              report.targets, len(report.problems))
+    if report.problems:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
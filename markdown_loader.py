@@ -0,0 +1,701 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reads Markdown files for the parser.
+
+Plain files under MMAP_THRESHOLD are read in one go.  Larger ones are
+memory-mapped and split into lines CHUNK_SIZE bytes at a time, straight
+into MarkdownParser.parse_lines(), so the file is never held as one string
+(or as a list of all its lines) next to its parsed segments.  That bounds
+only the reading: the segments hold the whole document as unicode, with a
+tuple and a tag list per segment, so memory still grows with the file and
+ends up at several times its size.
+
+Plain UTF-8 and Windows-1252 files over PAGE_THRESHOLD are therefore not
+parsed whole.  page_table() scans them once, without decoding, for line
+breaks about every PAGE_BYTES bytes and notes whether each falls inside a
+fenced code block; read_page() then parses one page, so memory follows
+the page rather than the file.  Reference definitions and footnotes only
+resolve within a page.
+
+Compressed files (.md.gz, .md.bz2) and members of zip archives are
+decompressed the same way, a chunk at a time, with no temporary file.  A
+member is named by a path through its archive, such as
+docs.zip/guide/intro.md, so that relative links between members resolve
+like links between files.  Only the archive's central directory and the
+member itself are read.
+
+The encoding is settled once per file, from a byte order mark or from
+whether the start of the file is valid UTF-8, and the bytes are decoded
+to unicode incrementally as they are split into lines.  \\r\\n and lone \\r
+line endings become \\n in the same pass, so the parser and the Text
+widget only ever see unicode with \\n line endings.
+"""
+
+import os
+import re
+import sys
+import stat
+import mmap
+import zlib
+import gzip
+import errno
+import codecs
+import struct
+import zipfile
+import threading
+
+try:
+    import bz2
+except ImportError:
+    # Python built without bzip2
+    bz2 = None
+
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.mdown', '.txt')
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2')
+ARCHIVE_EXTENSION = '.zip'
+
+MMAP_THRESHOLD = 4 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Bytes looked at to choose the encoding of a file without a byte order mark
+SNIFF_BYTES = 64 * 1024
+# Used when the start of a file isn't UTF-8: Markdown written on Windows
+FALLBACK_ENCODING = 'cp1252'
+
+# Plain files from this size on are shown a page at a time, each page
+# about PAGE_BYTES long (see page_table())
+PAGE_THRESHOLD = 16 * 1024 * 1024
+PAGE_BYTES = 2 * 1024 * 1024
+# Encodings in which byte 10 is always a newline
+PAGE_ENCODINGS = ('utf-8', FALLBACK_ENCODING)
+# What may come before the ``` of a line that opens or closes a fenced
+# code block, as the parser sees it
+FENCE_INDENT = ' \t\f\v'
+
+# Tcl before 8.7 holds only the Basic Multilingual Plane, and Tkinter
+# refuses a character above it from a wide (UCS-4) Python build; a narrow
+# build passes such characters on as surrogate pairs
+if sys.maxunicode > 0xffff:
+    # Negated, so that compiling it doesn't list every code point above
+    ASTRAL_PATTERN = re.compile(u'[^\x00-\uffff]')
+else:
+    ASTRAL_PATTERN = None
+
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+
+# Zip local file header: signature, versions, flags, method, time, date,
+# crc, sizes, and the lengths of the name and extra field that follow
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_SIGNATURE = 'PK\003\004'
+
+# archive path -> (mtime, size, {member name: ZipInfo})
+_archives = {}
+_archives_lock = threading.Lock()
+
+# path -> PageTable, or (mtime, size) for a file not read in pages
+_page_tables = {}
+_page_tables_lock = threading.Lock()
+
+
+def is_markdown(name):
+    """True if name is a Markdown file name, possibly compressed."""
+    root, extension = os.path.splitext(name.lower())
+    if extension in COMPRESSED_EXTENSIONS:
+        extension = os.path.splitext(root)[1]
+    return extension in MARKDOWN_EXTENSIONS
+
+
+def is_archive(path):
+    """True if path names a zip archive that could hold Markdown files."""
+    return path.lower().endswith(ARCHIVE_EXTENSION) and os.path.isfile(path)
+
+
+def split_archive_path(path):
+    """Return (archive, member) if path is a zip archive or a path inside
+    one (member is '' for the archive itself), else (None, path)."""
+    lower = path.lower()
+    marker = ARCHIVE_EXTENSION + os.sep
+    index = lower.find(marker)
+    while index != -1:
+        archive = path[:index + len(ARCHIVE_EXTENSION)]
+        if os.path.isfile(archive):
+            member = path[index + len(marker):]
+            return archive, member.replace(os.sep, '/')
+        index = lower.find(marker, index + 1)
+    if is_archive(path):
+        return path, ''
+    return None, path
+
+
+def _archive_members(archive, st, f=None):
+    """Return {name: ZipInfo} for archive, whose os.stat() result is st,
+    reading its central directory only when the archive has changed."""
+    _archives_lock.acquire()
+    try:
+        entry = _archives.get(archive)
+    finally:
+        _archives_lock.release()
+    if entry is not None and entry[0] == st.st_mtime and \
+            entry[1] == st.st_size:
+        return entry[2]
+    try:
+        zf = zipfile.ZipFile(f or archive)
+    except zipfile.BadZipfile, e:
+        raise IOError(errno.EINVAL, "Not a zip archive: %s" % e, archive)
+    try:
+        members = {}
+        for info in zf.infolist():
+            members[info.filename] = info
+    finally:
+        zf.close()
+    _archives_lock.acquire()
+    try:
+        _archives[archive] = (st.st_mtime, st.st_size, members)
+    finally:
+        _archives_lock.release()
+    return members
+
+
+def list_archive(archive, folder=''):
+    """Return [(name, is_folder)] for the folders and Markdown files
+    directly inside folder of archive, folders first, or None if the
+    archive can't be read."""
+    try:
+        members = _archive_members(archive, os.stat(archive))
+    except EnvironmentError:
+        return None
+    prefix = ''
+    if folder:
+        prefix = folder.rstrip('/') + '/'
+    entries = {}
+    for name in members:
+        if not name.startswith(prefix):
+            continue
+        rest = name[len(prefix):]
+        if '/' in rest:
+            child = rest.split('/', 1)[0]
+            if child and not child.startswith('.') and \
+                    child != '__MACOSX':
+                entries[child] = True
+        elif rest and not rest.startswith('.') and is_markdown(rest):
+            entries[rest] = False
+    ordered = [(not is_folder, name.lower(), name, is_folder)
+               for name, is_folder in entries.items()]
+    ordered.sort()
+    return [(name, is_folder) for order, key, name, is_folder in ordered]
+
+
+def walk_archive(archive):
+    """Return the paths of all Markdown files in archive, sorted."""
+    try:
+        members = _archive_members(archive, os.stat(archive))
+    except EnvironmentError:
+        return []
+    names = [name for name in members
+             if is_markdown(name) and not name.endswith('/') and
+             not name.startswith('__MACOSX/')]
+    names.sort()
+    return [os.path.join(archive, *name.split('/')) for name in names]
+
+
+def stat_path(path):
+    """os.stat() for path, which may be a member of a zip archive: then
+    the archive's status, with the uncompressed size of the member."""
+    archive, member = split_archive_path(path)
+    if archive is None or not member:
+        return os.stat(path)
+    st = os.stat(archive)
+    try:
+        info = _archive_members(archive, st).get(member)
+    except IOError:
+        info = None
+    if info is None:
+        raise OSError(errno.ENOENT, "No such file in archive", path)
+    return _sized_stat(st, info.file_size)
+
+
+def _sized_stat(st, size):
+    values = list(st[:10])
+    values[stat.ST_SIZE] = size
+    return os.stat_result(values)
+
+
+def is_compressed(path):
+    """True if path names a .gz or .bz2 file, whose uncompressed size
+    isn't known until it has been read."""
+    return os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def is_file(path):
+    """True if path is a file, or a file inside a zip archive."""
+    try:
+        return stat.S_ISREG(stat_path(path).st_mode)
+    except OSError:
+        return False
+
+
+def sniff_encoding(head, final=False):
+    """Return (encoding, bom_length) for a file starting with the bytes
+    head; final is true if head is the whole file, so that a character
+    cut short at its end counts against UTF-8."""
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if head.startswith(bom):
+            return encoding, len(bom)
+    try:
+        # Unless final, head may end part-way through a character
+        codecs.getincrementaldecoder('utf-8')().decode(head, final)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING, 0
+    return 'utf-8', 0
+
+
+class ChunkedLines(object):
+    """The lines of a file given as an iterable of chunks of bytes,
+    decoded to unicode one chunk at a time, without their line endings.
+
+    Gives the same lines as decoding the whole file and splitting it on
+    \\r\\n, \\r and \\n; count is the number of lines iterated so far,
+    size the number of bytes read, and encoding the one chosen from the
+    start of the file, unless one is given for chunks that don't start
+    the file.  Undecodable bytes become U+FFFD, and so do
+    characters the Text widget can't take (see ASTRAL_PATTERN).
+    """
+
+    def __init__(self, chunks, encoding=None):
+        self.chunks = chunks
+        self.count = 0
+        self.size = 0
+        self.encoding = encoding
+
+    def __iter__(self):
+        chunks = iter(self.chunks)
+        # Gather the start of the file to choose the encoding from,
+        # noting whether it is all there is
+        head = []
+        for data in chunks:
+            head.append(data)
+            self.size += len(data)
+            if self.size > SNIFF_BYTES:
+                break
+        data = ''.join(head)
+        if self.encoding is None:
+            self.encoding, bom_length = sniff_encoding(
+                data[:SNIFF_BYTES], self.size <= SNIFF_BYTES)
+        else:
+            bom_length = 0
+        decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+        # Pieces of a line that runs across chunk boundaries, joined once
+        # its end is found
+        pending = []
+        # A \r at the end of a chunk may be the first half of a \r\n
+        held = u''
+        data = data[bom_length:]
+        while True:
+            text = held + decoder.decode(data)
+            held = u''
+            if text.endswith(u'\r'):
+                held = u'\r'
+                text = text[:-1]
+            for line in self._split(text, pending):
+                yield line
+            try:
+                data = chunks.next()
+            except StopIteration:
+                break
+            self.size += len(data)
+        held += decoder.decode('', True)
+        for line in self._split(held, pending):
+            yield line
+        self.count += 1
+        yield u''.join(pending)
+
+    def _split(self, text, pending):
+        """Return the lines of text completed by its newlines; the rest
+        of it is left in pending."""
+        if u'\r' in text:
+            text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+        if ASTRAL_PATTERN is not None and ASTRAL_PATTERN.search(text):
+            text = ASTRAL_PATTERN.sub(u'\ufffd', text)
+        if u'\n' not in text:
+            if text:
+                pending.append(text)
+            return []
+        lines = text.split(u'\n')
+        if pending:
+            pending.append(lines[0])
+            lines[0] = u''.join(pending)
+        pending[:] = [lines.pop()]
+        self.count += len(lines)
+        return lines
+
+
+def _buffer_chunks(buffer, size):
+    for start in xrange(0, size, CHUNK_SIZE):
+        yield buffer[start:start + CHUNK_SIZE]
+
+
+def _stream_chunks(stream, path):
+    try:
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    except (zlib.error, EOFError, struct.error), e:
+        raise IOError(errno.EIO, "Damaged compressed file: %s" % e, path)
+
+
+def _bz2_chunks(f, path):
+    """Yield the decompressed contents of the bzip2 file open as f.
+
+    Parallel compressors write several streams one after another; each
+    is decompressed in turn.  Anything after the last stream that isn't
+    the start of another is ignored, as bzip2 itself does.
+    """
+    if bz2 is None:
+        raise IOError(errno.ENOSYS, "No bzip2 support in this Python", path)
+    decompressor = bz2.BZ2Decompressor()
+    data = f.read(CHUNK_SIZE)
+    while data:
+        try:
+            decompressed = decompressor.decompress(data)
+            unused = decompressor.unused_data
+        except EOFError:
+            # The stream ended with the previous chunk
+            decompressed = ''
+            unused = data
+        except IOError, e:
+            raise IOError(errno.EIO, "Damaged compressed file: %s" % e, path)
+        if decompressed:
+            yield decompressed
+        if not unused:
+            data = f.read(CHUNK_SIZE)
+            continue
+        while len(unused) < 3:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            unused += data
+        if not unused.startswith('BZh'):
+            return
+        decompressor = bz2.BZ2Decompressor()
+        data = unused
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        # The last stream was complete
+        return
+    raise IOError(errno.EIO, "Truncated compressed file", path)
+
+
+def _zip_member_chunks(f, info, path):
+    """Yield the decompressed contents of the zip member info from the
+    archive open as f, reading nothing but the member itself.
+
+    ZipFile.open() only arrived in Python 2.6, so the member is read from
+    its local header here.
+    """
+    if info.flag_bits & 0x1:
+        raise IOError(errno.EACCES, "Encrypted archive member", path)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif info.compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        raise IOError(errno.EINVAL, "Unsupported zip compression", path)
+    f.seek(info.header_offset)
+    header = f.read(ZIP_LOCAL_HEADER.size)
+    if len(header) != ZIP_LOCAL_HEADER.size or \
+            header[:4] != ZIP_LOCAL_SIGNATURE:
+        raise IOError(errno.EIO, "Damaged zip archive", path)
+    fields = ZIP_LOCAL_HEADER.unpack(header)
+    f.seek(fields[10] + fields[11], 1)
+    remaining = info.compress_size
+    try:
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                raise IOError(errno.EIO, "Truncated zip archive", path)
+            remaining -= len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            if data:
+                yield data
+        if decompressor is not None:
+            data = decompressor.flush()
+            if data:
+                yield data
+    except zlib.error, e:
+        raise IOError(errno.EIO, "Damaged zip archive: %s" % e, path)
+
+
+def read_markdown(path, parser, starts=None):
+    """Parse the Markdown file at path, which may be compressed or a
+    member of a zip archive.
+
+    Returns (segments, num_lines, st), where st is the os.fstat() result
+    for the opened file, with the size of its uncompressed contents (see
+    stat_path() for archive members).  starts is passed on to
+    MarkdownParser.parse_lines().  Raises IOError or OSError if it can't
+    be read.
+    """
+    def parse(lines):
+        return parser.parse_lines(lines, starts)
+    segments, lines, st = read_lines(path, parse)
+    return segments, lines.count, st
+
+
+def read_lines(path, use):
+    """Call use() with the lines of the Markdown file at path, read like
+    read_markdown() reads them, as a ChunkedLines.
+
+    Returns (use's result, the ChunkedLines, st), st as for
+    read_markdown().  use may stop iterating early; then only as much of
+    the file is read and decoded as it took, and the size in st of a
+    compressed file is only that of the part read.
+    """
+    archive, member = split_archive_path(path)
+    if archive is not None and not member:
+        raise IOError(errno.EISDIR, "Is an archive", path)
+    f = open(archive or path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        mapped = None
+        extension = os.path.splitext(path)[1].lower()
+        if archive is not None:
+            info = _archive_members(archive, st, f).get(member)
+            if info is None:
+                raise IOError(errno.ENOENT, "No such file in archive", path)
+            chunks = _zip_member_chunks(f, info, path)
+            st = _sized_stat(st, info.file_size)
+        elif extension == '.gz':
+            chunks = _stream_chunks(gzip.GzipFile(fileobj=f, mode='rb'),
+                                    path)
+        elif extension == '.bz2':
+            chunks = _bz2_chunks(f, path)
+        elif st.st_size >= MMAP_THRESHOLD:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except EnvironmentError:
+                # Not mappable (a pipe, some network volumes): read it
+                chunks = [f.read()]
+            else:
+                chunks = _buffer_chunks(mapped, st.st_size)
+        else:
+            chunks = [f.read()]
+        try:
+            lines = ChunkedLines(chunks)
+            result = use(lines)
+        finally:
+            if mapped is not None:
+                mapped.close()
+        if archive is None and extension in COMPRESSED_EXTENSIONS:
+            st = _sized_stat(st, lines.size)
+        return result, lines, st
+    finally:
+        f.close()
+
+
+class PageTable(object):
+    """Where the pages of a file shown a page at a time start.
+
+    pages holds (offset, line, fence) for each page: the byte offset and
+    number of its first line, and the line that opened the fenced code
+    block it starts inside (None if it doesn't).  A page may end part-way
+    through a table or footnote, and references are only resolved within
+    their page.
+    """
+
+    def __init__(self, path, encoding, size, mtime, pages, num_lines):
+        self.path = path
+        self.encoding = encoding
+        self.size = size
+        self.mtime = mtime
+        self.pages = pages
+        self.num_lines = num_lines
+
+    def page_of_line(self, line):
+        """Return the index of the page holding line."""
+        index = 0
+        for page in xrange(1, len(self.pages)):
+            if self.pages[page][1] > line:
+                break
+            index = page
+        return index
+
+
+def page_table(path):
+    """Return the PageTable of the file at path if it is shown a page at a
+    time, None if it is read whole.
+
+    Paged are plain files of at least PAGE_THRESHOLD bytes in one of
+    PAGE_ENCODINGS, with \\n or \\r\\n line endings.  The file is read
+    once, a chunk at a time, and the table kept until its size or mtime
+    changes.  Raises IOError or OSError if it can't be read.
+    """
+    archive, member = split_archive_path(path)
+    if archive is not None or \
+            os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return None
+    f = open(path, 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        if st.st_size < PAGE_THRESHOLD:
+            return None
+        key = os.path.abspath(path)
+        _page_tables_lock.acquire()
+        try:
+            table = _page_tables.get(key)
+        finally:
+            _page_tables_lock.release()
+        if isinstance(table, PageTable):
+            if (table.mtime, table.size) == (st.st_mtime, st.st_size):
+                return table
+        elif table == (st.st_mtime, st.st_size):
+            return None
+        table = _scan_pages(f, path, st)
+        _page_tables_lock.acquire()
+        try:
+            _page_tables[key] = table or (st.st_mtime, st.st_size)
+        finally:
+            _page_tables_lock.release()
+        return table
+    finally:
+        f.close()
+
+
+def _scan_pages(f, path, st):
+    """Build the PageTable of the file open as f, or return None if it
+    can't be read in pages.
+
+    Reads rather than maps the file, so that its pages don't stay
+    resident: only the newlines and fence lines are looked at.
+    """
+    head = f.read(SNIFF_BYTES)
+    encoding, bom_length = sniff_encoding(head)
+    if encoding not in PAGE_ENCODINGS:
+        return None
+    pages = [(bom_length, 1, None)]
+    next_page = bom_length + PAGE_BYTES
+    # Byte offset and number of the next line to look at
+    offset = bom_length
+    line = 1
+    fence = None
+    f.seek(offset)
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            break
+        end = data.rfind('\n') + 1
+        if end == 0:
+            # A line longer than a chunk: look at its start, then find
+            # its end
+            if data.lstrip(FENCE_INDENT).startswith('```'):
+                fence = fence is None and data[:256] or None
+            while end == 0:
+                offset += len(data)
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                end = data.find('\n') + 1
+            if not data:
+                break
+            offset += end
+            line += 1
+            f.seek(offset)
+            continue
+        # Whole lines only: the last, unfinished one is read again with
+        # the next chunk
+        region = data[:end]
+        if '\r' in region and region.count('\r') != region.count('\r\n'):
+            # Lone \r line endings, which the newline count would miss
+            return None
+        fences = _fence_lines(region)
+        index = 0
+        while offset + end > next_page:
+            start = max(next_page - offset, 0)
+            if start:
+                start = region.find('\n', start - 1) + 1
+            if start == 0 and next_page > offset or start >= end:
+                break
+            while index < len(fences) and fences[index] < start:
+                fence = _toggle_fence(fence, region, fences[index])
+                index += 1
+            pages.append((offset + start, line + region.count('\n', 0, start),
+                          fence))
+            next_page = offset + start + PAGE_BYTES
+        for position in fences[index:]:
+            fence = _toggle_fence(fence, region, position)
+        offset += end
+        line += region.count('\n')
+        if end < len(data):
+            f.seek(offset)
+    return PageTable(path, encoding, st.st_size, st.st_mtime, pages, line)
+
+
+def _fence_lines(region):
+    """Return the offsets of the lines of region, which ends with a
+    newline, that open or close a fenced code block."""
+    found = []
+    position = region.find('```')
+    while position != -1:
+        start = region.rfind('\n', 0, position) + 1
+        if not region[start:position].strip(FENCE_INDENT):
+            found.append(start)
+        # Only the first ``` of a line can start it
+        position = region.find('```', region.find('\n', position) + 1)
+    return found
+
+
+def _toggle_fence(fence, region, start):
+    """Return the open fence after the fence line at start in region."""
+    if fence is not None:
+        return None
+    return region[start:region.find('\n', start)].rstrip('\r')
+
+
+def read_page(path, parser, index, starts=None):
+    """Parse page index of the file at path, if it is shown a page at a
+    time (see page_table()).
+
+    Returns (segments, table, index), index brought into range, or None
+    if the file is read whole.  starts, if given, gets the source line of
+    each segment, numbered within the whole file.  Raises IOError or
+    OSError if it can't be read.
+    """
+    table = page_table(path)
+    if table is None:
+        return None
+    index = max(0, min(index, len(table.pages) - 1))
+    offset, line, fence = table.pages[index]
+    if index + 1 < len(table.pages):
+        end = table.pages[index + 1][0]
+    else:
+        end = table.size
+    f = open(path, 'rb')
+    try:
+        f.seek(offset)
+        data = f.read(end - offset)
+    finally:
+        f.close()
+    if index + 1 < len(table.pages):
+        # The page's last newline ends it rather than starting a line
+        data = data[:-1]
+        if data.endswith('\r'):
+            data = data[:-1]
+    chunks = [data]
+    if fence is not None:
+        # Reopen the code block the page starts inside
+        chunks.insert(0, fence + '\n')
+        line -= 1
+    segments = parser.parse_lines(ChunkedLines(chunks, table.encoding),
+                                  starts)
+    if starts is not None:
+        starts[:] = [start + line - 1 for start in starts]
+    return segments, table, index
@@ -5,14 +5,151 @@ Lightweight Markdown parser for Python 2.5 / PowerPC Mac.
 Converts Markdown text into a list of tagged segments for Tkinter Text widget.
 
 Each segment is a tuple: (text, [tag1, tag2, ...])
+
+Fenced code blocks are tagged ['code_block', 'fence-0'], plus 'lang-<name>'
+when the opening fence names a language (```python gives 'lang-python').
+The fence tag alternates between 'fence-0' and 'fence-1' from one block to
+the next, so that blocks with nothing between them can be told apart.
+
+Pipe tables are laid out here, as monospace text with padded columns: the
+header row and a separator come as one ['table_header'] segment and the
+remaining rows as one ['table'] segment.  Links in cells are kept, split
+out as link_text and link_url segments with the table tag as in running
+text; reference links and footnote markers in cells are resolved with
+the others, so such a table is laid out at the end.  As on GitHub, the delimiter row must have as many cells as the
+header row.
+
+Reference links ([text][ref], [text][] and [text]) and footnotes ([^id])
+are resolved against definitions collected during the same block scan;
+footnotes are listed after a rule at the end, their markers tagged
+'footnote_ref'.
+
+Lines longer than MarkdownParser.LONG_LINE (minified JSON, generated data)
+are broken into rows of at most LINE_CHUNK characters and shown without
+inline formatting; their segments carry an extra 'long_line' tag.
 """
 
 import re
+from unicodedata import east_asian_width
+
+# The first wide block (Hangul Jamo) starts here
+_FIRST_WIDE = u'\u1100'
+
+
+def _text_width(text):
+    """Number of columns text takes in a monospace font (UTF-8 when it is
+    a byte string): wide East Asian characters count twice."""
+    if isinstance(text, str):
+        try:
+            text = text.decode('utf-8')
+        except UnicodeError:
+            return len(text)
+    width = len(text)
+    if text and max(text) >= _FIRST_WIDE:
+        for char in text:
+            if east_asian_width(char) in ('W', 'F'):
+                width += 1
+    return width
+
+
+def _reference_key(label):
+    """Normalise a reference label: case and runs of spaces don't count."""
+    return ' '.join(label.split()).lower()
+
+
+class _References(object):
+    """Link and footnote definitions found while parsing one document."""
+
+    def __init__(self):
+        self.links = {}
+        self.footnotes = {}
+        # Footnote key -> source line of its definition
+        self.footnote_lines = {}
+        self.used = False
+
+
+class _Lookahead(object):
+    """An iterator over lines that can also peek at the next line."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._next = None
+        self._peeked = False
+        # Lines consumed so far, so the number of the last one returned
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._peeked:
+            self._peeked = False
+            line = self._next
+        else:
+            line = self._lines.next()
+        self.count += 1
+        return line
+
+    def peek(self):
+        """Return the next line without consuming it, or None at the end."""
+        if not self._peeked:
+            try:
+                self._next = self._lines.next()
+            except StopIteration:
+                return None
+            self._peeked = True
+        return self._next
+
+
+class _Reference(object):
+    """A reference in the segment list, resolved once the whole document
+    (and so every definition) has been scanned."""
+
+    __slots__ = ('kind', 'text', 'key', 'raw', 'tags')
+
+    def __init__(self, kind, text, key, raw, tags):
+        self.kind = kind
+        self.text = text
+        self.key = key
+        self.raw = raw
+        self.tags = tags
+
+
+class _Table(object):
+    """A table whose cells hold references, laid out once they have been
+    resolved: until then the widths of its columns are not known."""
+
+    __slots__ = ('cells', 'aligns')
+
+    def __init__(self, cells, aligns):
+        self.cells = cells
+        self.aligns = aligns
+
+
+def _row_starts(segments, line_number):
+    """Source lines of table segments laid out a row per line from
+    line_number, a _Table counting as the whole table."""
+    starts = []
+    for segment in segments:
+        starts.append(line_number)
+        if not isinstance(segment, _Table):
+            line_number += segment[0].count('\n')
+    return starts
 
 
 class MarkdownParser(object):
     """Parses a subset of Markdown into tagged segments for display."""
 
+    # Lines longer than this are not formatted, and are broken into rows
+    # of at most LINE_CHUNK characters: Tk's Text slows down badly on very
+    # long lines, and inline parsing of them is expensive.
+    LONG_LINE = 4000
+    LINE_CHUNK = 1000
+    # Inline text longer than this is parsed by position, keeping each
+    # pattern's next match; shorter text is cut down after each match,
+    # which is quicker while there is little to search again.
+    SCAN_INLINE = 200
+
     def __init__(self):
         # Inline patterns (order matters - bold before italic)
         # Italic patterns use negative lookbehind/lookahead for * to avoid
@@ -32,47 +169,141 @@ class MarkdownParser(object):
             # Strikethrough
             (re.compile(r'~~(.+?)~~'), ['strikethrough']),
         ]
+        # The same patterns without their leading lookbehind, for matching
+        # right where the previous match ended: the text before it has been
+        # consumed, so a closing * must not stop an opening one.
+        self.head_patterns = {}
+        for pattern, tags in self.inline_patterns:
+            if pattern.pattern.startswith('(?<!'):
+                source = pattern.pattern
+                self.head_patterns[pattern] = re.compile(
+                    source[source.index(')') + 1:])
 
         # Link pattern: [text](url)
         self.link_pattern = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
         # Image pattern: ![alt](path)
         self.image_pattern = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
 
+        # Table delimiter row: | --- | :---: | ---: |
+        self.table_delimiter = re.compile(
+            r'^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$')
+        # Cell separator: a pipe not escaped with a backslash
+        self.cell_separator = re.compile(r'(?<!\\)\|')
+        # Anything that could start inline markup or a link in a table row
+        self.row_markup = re.compile(r'[*_`~\[]')
+        # A link held out of a table cell while its markup is removed
+        self.held_pattern = re.compile('\0(\\d+)\0')
+
+        # Reference definitions: [ref]: url "title" and [^note]: text
+        self.link_definition = re.compile(
+            r'^ {0,3}\[([^\]^][^\]]*)\]:\s*<?([^\s>]+)>?'
+            r'(?:\s+(?:"[^"]*"|\'[^\']*\'|\([^)]*\)))?\s*$')
+        self.footnote_definition = re.compile(r'^ {0,3}\[\^([^\]\s]+)\]:\s*(.*)$')
+        # Reference uses: [^note], [text][ref] / [text][], and [text]
+        self.footnote_pattern = re.compile(r'\[\^([^\]\s]+)\]')
+        self.reference_pattern = re.compile(r'\[([^\]]+)\]\[([^\]]*)\]')
+        self.shortcut_pattern = re.compile(r'\[(?!\^)([^\]]+)\](?![\[(:])')
+
     def parse(self, text):
         """Parse markdown text and return list of (text, tags) segments."""
-        lines = text.split('\n')
+        return self.parse_lines(text.split('\n'))
+
+    def parse_lines(self, lines, starts=None):
+        """Parse an iterable of lines (without their newlines) and return
+        the list of (text, tags) segments.
+
+        Looks at most one line ahead, so lines can be a generator reading
+        a file in chunks rather than a list of the whole document.
+
+        If starts is a list, it is filled with the (1-based) source line
+        each segment comes from.  The rendered text drops some lines
+        (fences, definitions, setext underlines) and adds others, so
+        counting its newlines doesn't give source lines.
+        """
+        lines = _Lookahead(lines)
         segments = []
         in_code_block = False
         code_block_lines = []
+        code_tags = ['code_block']
+        fence = 1
+        code_start = 1
+        block_start = 1
+        refs = _References()
+
+        def mark(line_number):
+            # The segments added since the last mark come from line_number
+            if starts is not None:
+                starts.extend([line_number] * (len(segments) - len(starts)))
 
-        i = 0
-        while i < len(lines):
-            line = lines[i]
+        for line in lines:
+            mark(block_start)
+            block_start = lines.count
 
             # Fenced code blocks
             if line.strip().startswith('```'):
                 if in_code_block:
                     code_text = '\n'.join(code_block_lines)
                     if code_text:
-                        segments.append((code_text + '\n', ['code_block']))
+                        segments.append((code_text + '\n', code_tags))
+                        mark(code_start)
                     code_block_lines = []
                     in_code_block = False
                 else:
                     in_code_block = True
-                i += 1
+                    code_start = lines.count + 1
+                    fence = 1 - fence
+                    code_tags = ['code_block', 'fence-%d' % fence]
+                    info = line.strip()[3:].split()
+                    if info:
+                        code_tags.append('lang-' + info[0].lower())
                 continue
 
             if in_code_block:
-                code_block_lines.append(line)
-                i += 1
+                if len(line) > self.LONG_LINE:
+                    if code_block_lines:
+                        segments.append(('\n'.join(code_block_lines) + '\n',
+                                         code_tags))
+                        mark(code_start)
+                        code_block_lines = []
+                    segments.append((self._break_long_line(line) + '\n',
+                                     code_tags + ['long_line']))
+                    code_start = lines.count + 1
+                else:
+                    code_block_lines.append(line)
                 continue
 
             # Blank line
             if line.strip() == '':
                 segments.append(('\n', ['normal']))
-                i += 1
                 continue
 
+            if len(line) > self.LONG_LINE:
+                segments.append((self._break_long_line(line) + '\n',
+                                 ['normal', 'long_line']))
+                continue
+
+            # Link and footnote definitions are collected, not shown
+            if line.lstrip().startswith('['):
+                definition = self.link_definition.match(line)
+                if definition:
+                    refs.links.setdefault(_reference_key(definition.group(1)),
+                                          definition.group(2))
+                    continue
+                definition = self.footnote_definition.match(line)
+                if definition:
+                    body = [definition.group(2).strip()]
+                    # Indented lines continue the footnote
+                    following = lines.peek()
+                    while following is not None and \
+                            following[:1] in (' ', '\t') and following.strip():
+                        body.append(lines.next().strip())
+                        following = lines.peek()
+                    key = _reference_key(definition.group(1))
+                    if key not in refs.footnotes:
+                        refs.footnotes[key] = ' '.join(body)
+                        refs.footnote_lines[key] = block_start
+                    continue
+
             # Headings (ATX style)
             heading_match = re.match(r'^(#{1,6})\s+(.+?)(?:\s*#*\s*)?$', line)
             if heading_match:
@@ -80,25 +311,37 @@ class MarkdownParser(object):
                 text_content = heading_match.group(2)
                 tag = 'h%d' % level
                 segments.append((text_content + '\n', [tag]))
-                i += 1
+                continue
+
+            # Pipe tables: a row followed by a delimiter row
+            following = lines.peek()
+            if '|' in line and following is not None and \
+                    '|' in following and \
+                    self.table_delimiter.match(following) and \
+                    len(self._split_row(following)) == \
+                    len(self._split_row(line)):
+                first = len(segments)
+                self._parse_table(line, lines, segments, refs)
+                if starts is not None:
+                    # Laid out a row per source line, delimiter included
+                    starts.extend(_row_starts(segments[first:], block_start))
                 continue
 
             # Setext-style headings
-            if i + 1 < len(lines):
-                next_line = lines[i + 1].strip()
+            if following is not None:
+                next_line = following.strip()
                 if next_line and all(c == '=' for c in next_line) and len(next_line) >= 2:
                     segments.append((line + '\n', ['h1']))
-                    i += 2
+                    lines.next()
                     continue
                 if next_line and all(c == '-' for c in next_line) and len(next_line) >= 2:
                     segments.append((line + '\n', ['h2']))
-                    i += 2
+                    lines.next()
                     continue
 
             # Horizontal rule
             if re.match(r'^(\*{3,}|-{3,}|_{3,})\s*$', line.strip()):
                 segments.append(('-' * 40 + '\n', ['hr']))
-                i += 1
                 continue
 
             # Unordered list items
@@ -109,8 +352,8 @@ class MarkdownParser(object):
                 prefix = '  ' * bullet_level + '* '
                 content = list_match.group(2)
                 segments.append((prefix, ['list_bullet']))
-                self._parse_inline(content + '\n', segments, ['list_item'])
-                i += 1
+                self._parse_inline(content + '\n', segments, ['list_item'],
+                                   refs)
                 continue
 
             # Ordered list items
@@ -122,8 +365,8 @@ class MarkdownParser(object):
                 prefix = '  ' * bullet_level + number + '. '
                 content = olist_match.group(3)
                 segments.append((prefix, ['list_bullet']))
-                self._parse_inline(content + '\n', segments, ['list_item'])
-                i += 1
+                self._parse_inline(content + '\n', segments, ['list_item'],
+                                   refs)
                 continue
 
             # Blockquote
@@ -131,23 +374,359 @@ class MarkdownParser(object):
             if bq_match:
                 content = bq_match.group(1)
                 segments.append(('  | ', ['blockquote_bar']))
-                self._parse_inline(content + '\n', segments, ['blockquote'])
-                i += 1
+                self._parse_inline(content + '\n', segments, ['blockquote'],
+                                   refs)
                 continue
 
             # Normal paragraph
-            self._parse_inline(line + '\n', segments, ['normal'])
-            i += 1
+            self._parse_inline(line + '\n', segments, ['normal'], refs)
+
+        mark(block_start)
 
         # Handle unclosed code block
         if in_code_block and code_block_lines:
             code_text = '\n'.join(code_block_lines)
-            segments.append((code_text + '\n', ['code_block']))
+            segments.append((code_text + '\n', code_tags))
+            mark(code_start)
 
+        if refs.used:
+            segments = self._resolve_references(segments, refs, starts,
+                                                max(lines.count, 1))
         return segments
 
-    def _parse_inline(self, text, segments, base_tags):
-        """Parse inline formatting within text, with recursion for nesting."""
+    def _resolve_references(self, segments, refs, starts=None, last_line=1):
+        """Replace the reference placeholders in segments, numbering the
+        footnotes in order of first use and listing them at the end.
+
+        starts, if given, holds the source lines of segments and is
+        updated to match the result; the listed footnotes come from the
+        lines of their definitions.
+        """
+        resolved = []
+        numbers = {}
+        order = []
+        if starts is None:
+            self._resolve_into(segments, refs, resolved, numbers, order)
+        else:
+            resolved_starts = []
+            for index in xrange(len(segments)):
+                self._resolve_into(segments[index:index + 1], refs, resolved,
+                                   numbers, order)
+                if isinstance(segments[index], _Table):
+                    resolved_starts.extend(_row_starts(
+                        resolved[len(resolved_starts):], starts[index]))
+                else:
+                    resolved_starts.extend(
+                        [starts[index]] *
+                        (len(resolved) - len(resolved_starts)))
+        if order:
+            resolved.append(('\n', ['normal']))
+            resolved.append(('-' * 40 + '\n', ['hr']))
+            if starts is not None:
+                resolved_starts.extend([last_line] * 2)
+            # Footnotes may refer to further footnotes, growing order
+            index = 0
+            while index < len(order):
+                key = order[index]
+                index += 1
+                resolved.append(('[%d] ' % numbers[key], ['footnote_ref']))
+                content = []
+                self._parse_inline(refs.footnotes[key] + '\n', content,
+                                   ['normal'], refs)
+                self._resolve_into(content, refs, resolved, numbers, order)
+                if starts is not None:
+                    resolved_starts.extend(
+                        [refs.footnote_lines[key]] *
+                        (len(resolved) - len(resolved_starts)))
+        if starts is not None:
+            starts[:] = resolved_starts
+        return resolved
+
+    def _resolve_into(self, segments, refs, resolved, numbers, order):
+        for segment in segments:
+            if isinstance(segment, _Table):
+                cells = []
+                for row, markup in segment.cells:
+                    if markup:
+                        row = [self._resolve_cell(pieces, refs, numbers,
+                                                  order)
+                               for pieces in row]
+                    cells.append((row, markup))
+                self._lay_out_table(cells, segment.aligns, resolved)
+            elif not isinstance(segment, _Reference):
+                resolved.append(segment)
+            elif segment.kind == 'footnote':
+                if segment.key not in refs.footnotes:
+                    resolved.append((segment.raw, segment.tags))
+                    continue
+                if segment.key not in numbers:
+                    order.append(segment.key)
+                    numbers[segment.key] = len(order)
+                resolved.append(('[%d]' % numbers[segment.key],
+                                 segment.tags + ['footnote_ref']))
+            else:
+                url = refs.links.get(segment.key)
+                if url is None:
+                    resolved.append((segment.raw, segment.tags))
+                    continue
+                resolved.append((segment.text, segment.tags + ['link_text']))
+                resolved.append((' (', list(segment.tags)))
+                resolved.append((url, segment.tags + ['link_url']))
+                resolved.append((')', list(segment.tags)))
+
+    def _resolve_cell(self, pieces, refs, numbers, order):
+        """Return a table cell's pieces with its references resolved."""
+        resolved = []
+        for piece in pieces:
+            if isinstance(piece, _Reference):
+                self._resolve_into([piece], refs, resolved, numbers, order)
+            else:
+                resolved.append(piece)
+        return resolved
+
+    def _parse_table(self, line, lines, segments, refs=None):
+        """Lay out the table whose header row is line, reading its
+        delimiter and body rows from lines.
+
+        Cells are reduced to plain text apart from their links, so a
+        table without links is shown as two segments with no per-cell
+        tags.  With refs, a table whose cells hold references is added
+        as a _Table for the end pass to lay out.
+        """
+        header = self._split_row(line)
+        aligns = []
+        for cell in self._split_row(lines.next()):
+            cell = cell.strip()
+            if cell.startswith(':') and cell.endswith(':'):
+                aligns.append('center')
+            elif cell.endswith(':'):
+                aligns.append('right')
+            else:
+                aligns.append('left')
+        columns = len(header)
+        aligns.extend(['left'] * (columns - len(aligns)))
+
+        # Rows as (cells, whether the row holds any markup)
+        rows = [(header, self.row_markup.search(line))]
+        following = lines.peek()
+        while following is not None and '|' in following and \
+                following.strip() and len(following) <= self.LONG_LINE:
+            rows.append((self._split_row(following),
+                         self.row_markup.search(following)))
+            lines.next()
+            following = lines.peek()
+
+        # Each row as (cells, whether the row holds markup).  The cells
+        # of a row without markup are kept as plain strings, the others
+        # as pieces.
+        cells = []
+        held = False
+        for row, markup in rows:
+            row = [cell.strip() for cell in row[:columns]]
+            row.extend([''] * (columns - len(row)))
+            if markup:
+                row = [self._cell_pieces(cell, refs) for cell in row]
+                for pieces in row:
+                    for piece in pieces:
+                        if isinstance(piece, _Reference):
+                            held = True
+            cells.append((row, markup))
+        if held:
+            refs.used = True
+            segments.append(_Table(cells, aligns))
+        else:
+            self._lay_out_table(cells, aligns, segments)
+
+    def _lay_out_table(self, cells, aligns, segments):
+        """Pad the rows of cells, as found by _parse_table, into their
+        columns and append them as table segments."""
+        columns = len(aligns)
+        widths = [0] * columns
+        table = []
+        for row, markup in cells:
+            row_widths = []
+            for col in xrange(columns):
+                if markup:
+                    width = 0
+                    for text, tags in row[col]:
+                        width += _text_width(text)
+                else:
+                    width = _text_width(row[col])
+                if width > widths[col]:
+                    widths[col] = width
+                row_widths.append(width)
+            table.append((zip(row, row_widths), markup))
+
+        # Each row as (text, extra tags) pieces, padded into its columns
+        formatted = []
+        for sized, markup in table:
+            if not markup:
+                padded = []
+                for col in xrange(columns):
+                    text, width = sized[col]
+                    space = widths[col] - width
+                    if aligns[col] == 'right':
+                        padded.append(' ' * space + text)
+                    elif aligns[col] == 'center':
+                        padded.append(' ' * (space // 2) + text +
+                                      ' ' * (space - space // 2))
+                    else:
+                        padded.append(text + ' ' * space)
+                formatted.append([(' | '.join(padded).rstrip() + '\n', [])])
+                continue
+            row = []
+            for col in xrange(columns):
+                pieces, width = sized[col]
+                space = widths[col] - width
+                if col:
+                    row.append((' | ', []))
+                if aligns[col] == 'right':
+                    row.append((' ' * space, []))
+                    row.extend(pieces)
+                elif aligns[col] == 'center':
+                    row.append((' ' * (space // 2), []))
+                    row.extend(pieces)
+                    row.append((' ' * (space - space // 2), []))
+                else:
+                    row.extend(pieces)
+                    row.append((' ' * space, []))
+            while row and not row[-1][1] and not row[-1][0].rstrip():
+                row.pop()
+            if row and not row[-1][1]:
+                row[-1] = (row[-1][0].rstrip(), [])
+            row.append(('\n', []))
+            formatted.append(row)
+
+        separator = '-+-'.join(['-' * width for width in widths])
+        self._append_pieces(formatted[0], ['table_header'], segments)
+        body = [(separator + '\n', [])]
+        for row in formatted[1:]:
+            body.extend(row)
+        self._append_pieces(body, ['table'], segments)
+
+    def _cell_pieces(self, text, refs=None):
+        """Return a table cell's text as (text, extra tags) pieces with the
+        inline markup removed; links keep their URL, split out as in
+        running text so that they can be followed and checked.
+
+        With refs, reference links and footnote markers become _Reference
+        pieces, as in _parse_inline.
+        """
+        links = []
+
+        def hold(match):
+            links.append(match)
+            return '\0%d\0' % (len(links) - 1)
+
+        def unhold(text):
+            # A held image in a label stands for its alt text
+            return self.held_pattern.sub(
+                lambda held: links[int(held.group(1))].group(1) or 'image',
+                text)
+        # Links are held out of the way while the formatting is removed,
+        # which could otherwise eat the underscores of a URL
+        text = self.image_pattern.sub(hold, text)
+        text = self.link_pattern.sub(hold, text)
+        if refs is not None and '[' in text:
+            text = self.footnote_pattern.sub(hold, text)
+            text = self.reference_pattern.sub(hold, text)
+            text = self.shortcut_pattern.sub(hold, text)
+        text = self._strip_formatting(text)
+        pieces = []
+        parts = text.split('\0')
+        for index in xrange(len(parts)):
+            part = parts[index]
+            if index % 2 == 0:
+                if part:
+                    pieces.append((part, []))
+                continue
+            match = links[int(part)]
+            if match.re is self.image_pattern:
+                pieces.append((match.group(1) or 'image', []))
+            elif match.re is not self.link_pattern:
+                label = self._strip_formatting(unhold(match.group(1)))
+                if match.re is self.footnote_pattern:
+                    kind = 'footnote'
+                    key = match.group(1)
+                else:
+                    kind = 'link'
+                    key = match.group(1)
+                    if match.re is self.reference_pattern and \
+                            match.group(2).strip():
+                        key = match.group(2)
+                pieces.append(_Reference(
+                    kind, label, _reference_key(key),
+                    self._strip_formatting(unhold(match.group(0))), []))
+                continue
+            else:
+                # The label may hold an image, as in [![badge](b.png)](url)
+                label = unhold(match.group(1))
+                pieces.append((self._strip_formatting(label), ['link_text']))
+            pieces.append((' (', []))
+            pieces.append((match.group(2), ['link_url']))
+            pieces.append((')', []))
+        return pieces
+
+    def _strip_formatting(self, text):
+        for pattern, tags in self.inline_patterns:
+            text = pattern.sub(r'\1', text)
+        return text
+
+    def _append_pieces(self, pieces, base_tags, segments):
+        """Append (text, extra tags) pieces as segments tagged base_tags,
+        running the plain pieces together into as few as possible."""
+        plain = []
+        for text, tags in pieces:
+            if not tags:
+                plain.append(text)
+                continue
+            if plain:
+                segments.append((''.join(plain), list(base_tags)))
+                plain = []
+            segments.append((text, base_tags + tags))
+        if plain:
+            segments.append((''.join(plain), list(base_tags)))
+
+    def _break_long_line(self, line):
+        """Return line with newlines inserted so that no row is longer than
+        LINE_CHUNK, breaking after a space where there is one nearby."""
+        chunk = self.LINE_CHUNK
+        rows = []
+        start = 0
+        while len(line) - start > chunk:
+            end = line.rfind(' ', start + chunk // 2, start + chunk)
+            if end != -1:
+                end += 1
+            else:
+                end = start + chunk
+                if isinstance(line, str):
+                    # Don't split a UTF-8 sequence
+                    while end > start + 1 and '\x80' <= line[end] <= '\xbf':
+                        end -= 1
+            rows.append(line[start:end])
+            start = end
+        rows.append(line[start:])
+        return '\n'.join(rows)
+
+    def _split_row(self, line):
+        """Split a table row into its cells, dropping the outer pipes."""
+        line = line.strip()
+        if line.startswith('|'):
+            line = line[1:]
+        if line.endswith('|') and not line.endswith('\\|'):
+            line = line[:-1]
+        return [cell.replace('\\|', '|')
+                for cell in self.cell_separator.split(line)]
+
+    def _parse_inline(self, text, segments, base_tags, refs=None):
+        """Parse inline formatting within text, with recursion for nesting.
+
+        With refs, reference links and footnote markers become _Reference
+        placeholders that parse() resolves at the end.
+        """
+        if len(text) > self.SCAN_INLINE:
+            self._scan_inline(text, segments, base_tags, refs)
+            return
         while text:
             earliest_match = None
             earliest_start = len(text)
@@ -170,6 +749,17 @@ class MarkdownParser(object):
                     earliest_start = link_m.start()
                     earliest_type = 'link'
 
+            # Check references (resolved later, once all are defined)
+            if refs is not None and '[' in text:
+                for kind, pattern in (('footnote', self.footnote_pattern),
+                                      ('reference', self.reference_pattern),
+                                      ('shortcut', self.shortcut_pattern)):
+                    m = pattern.search(text)
+                    if m and m.start() < earliest_start:
+                        earliest_match = m
+                        earliest_start = m.start()
+                        earliest_type = kind
+
             # Check inline formatting patterns
             for pattern, tags in self.inline_patterns:
                 m = pattern.search(text)
@@ -180,45 +770,122 @@ class MarkdownParser(object):
                     earliest_type = 'format'
 
             if earliest_match is None:
-                if text:
-                    segments.append((text, list(base_tags)))
+                segments.append((text, list(base_tags)))
                 break
 
             # Text before the match
             if earliest_start > 0:
                 segments.append((text[:earliest_start], list(base_tags)))
+            self._append_match(earliest_type, earliest_match,
+                               earliest_pattern_tags, segments, base_tags,
+                               refs)
+            text = text[earliest_match.end():]
 
-            if earliest_type == 'image':
-                alt_text = earliest_match.group(1) or 'image'
-                img_path = earliest_match.group(2)
-                segments.append(('[', list(base_tags)))
-                segments.append(('img', list(base_tags) + ['image_icon']))
-                segments.append((': ', list(base_tags)))
-                if alt_text:
-                    segments.append((alt_text, list(base_tags) + ['bold']))
-                segments.append((' \u2192 ', list(base_tags)))
-                segments.append((img_path, list(base_tags) + ['link_url']))
-                segments.append((']', list(base_tags)))
-            elif earliest_type == 'link':
-                link_text = earliest_match.group(1)
-                link_url = earliest_match.group(2)
-                segments.append((link_text, list(base_tags) + ['link_text']))
-                segments.append((' (', list(base_tags)))
-                segments.append((link_url, list(base_tags) + ['link_url']))
-                segments.append((')', list(base_tags)))
-            else:
-                # Inline formatting - recurse for nested formatting
-                inner_text = earliest_match.group(1)
-                combined_tags = list(base_tags) + list(earliest_pattern_tags)
-                # Recurse to handle nested inline formatting (e.g. bold inside italic)
-                # But don't recurse for code_inline - it should be literal
-                if 'code_inline' in earliest_pattern_tags:
-                    segments.append((inner_text, combined_tags))
-                else:
-                    self._parse_inline(inner_text, segments, combined_tags)
+    def _scan_inline(self, text, segments, base_tags, refs):
+        """_parse_inline for long text.
+
+        Works through text by position.  Each pattern's next match is kept
+        and only searched again once the position has passed it, so a line
+        is scanned a bounded number of times however much markup it has.
+        A lookbehind never sees text before the position, as if the rest
+        of the line were parsed on its own.
+        """
+        # (type, pattern, tags): images before links, since ![...] starts
+        # with !; on a tie the earlier entry wins
+        patterns = [('image', self.image_pattern, None),
+                    ('link', self.link_pattern, None)]
+        if refs is not None and '[' in text:
+            # References are resolved later, once all are defined
+            patterns.append(('footnote', self.footnote_pattern, None))
+            patterns.append(('reference', self.reference_pattern, None))
+            patterns.append(('shortcut', self.shortcut_pattern, None))
+        for pattern, tags in self.inline_patterns:
+            patterns.append(('format', pattern, tags))
+        matches = [pattern.search(text) for kind, pattern, tags in patterns]
+        heads = [self.head_patterns.get(pattern)
+                 for kind, pattern, tags in patterns]
+
+        pos = 0
+        while pos < len(text):
+            earliest_match = None
+            earliest_start = len(text)
+            earliest_pattern_tags = None
+            earliest_type = None
+
+            for index in xrange(len(patterns)):
+                m = matches[index]
+                if m is not None and m.start() < pos:
+                    m = patterns[index][1].search(text, pos)
+                    matches[index] = m
+                if heads[index] is not None and pos < earliest_start and \
+                        (m is None or m.start() > pos):
+                    m = heads[index].match(text, pos) or m
+                if m is None or m.start() >= earliest_start:
+                    continue
+                kind = patterns[index][0]
+                # Make sure a link isn't part of an image (preceded by !)
+                if kind == 'link' and m.start() > pos and \
+                        text[m.start() - 1] == '!':
+                    continue
+                earliest_match = m
+                earliest_start = m.start()
+                earliest_type = kind
+                earliest_pattern_tags = patterns[index][2]
 
-            text = text[earliest_match.end():]
+            if earliest_match is None:
+                segments.append((text[pos:], list(base_tags)))
+                break
 
+            # Text before the match
+            if earliest_start > pos:
+                segments.append((text[pos:earliest_start], list(base_tags)))
+            self._append_match(earliest_type, earliest_match,
+                               earliest_pattern_tags, segments, base_tags,
+                               refs)
+            pos = earliest_match.end()
+
+    def _append_match(self, kind, match, pattern_tags, segments, base_tags,
+                      refs):
+        """Append the segments for one inline match found by
+        _parse_inline: an image, link, reference or formatted run."""
+        if kind == 'image':
+            alt_text = match.group(1) or 'image'
+            img_path = match.group(2)
+            segments.append(('[', list(base_tags)))
+            segments.append(('img', list(base_tags) + ['image_icon']))
+            segments.append((': ', list(base_tags)))
+            if alt_text:
+                segments.append((alt_text, list(base_tags) + ['bold']))
+            segments.append((u' \u2192 ', list(base_tags)))
+            segments.append((img_path, list(base_tags) + ['link_url']))
+            segments.append((']', list(base_tags)))
+        elif kind in ('footnote', 'reference', 'shortcut'):
+            refs.used = True
+            label = match.group(1)
+            key = label
+            if kind == 'reference' and match.group(2).strip():
+                key = match.group(2)
+            if kind != 'footnote':
+                kind = 'link'
+            segments.append(_Reference(kind, label, _reference_key(key),
+                                       match.group(0), list(base_tags)))
+        elif kind == 'link':
+            link_text = match.group(1)
+            link_url = match.group(2)
+            segments.append((link_text, list(base_tags) + ['link_text']))
+            segments.append((' (', list(base_tags)))
+            segments.append((link_url, list(base_tags) + ['link_url']))
+            segments.append((')', list(base_tags)))
+        else:
+            # Inline formatting - recurse for nested formatting
+            inner_text = match.group(1)
+            combined_tags = list(base_tags) + list(pattern_tags)
+            # Recurse to handle nested inline formatting (e.g. bold inside italic)
+            # But don't recurse for code_inline - it should be literal
+            if 'code_inline' in pattern_tags:
+                segments.append((inner_text, combined_tags))
+            else:
+                self._parse_inline(inner_text, segments, combined_tags, refs)
 
 if __name__ == '__main__':
     test = """# Hello World
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Full-text search across a folder of Markdown files.
+
+The index maps each term to the files containing it, with the number of
+times it occurs in each and where it first occurs: the character offset
+in the parser's plain-text output (the text the viewer displays) and the
+line of the source file.  It is pickled to disk and brought up to date by
+comparing file modification times, so only changed files are re-parsed.
+
+The text itself isn't kept.  A result's snippet is cut from the source
+line where the hit first occurs, read again when the query runs; for
+plain files the index keeps the byte offset of every LINE_STEP'th line,
+so that only a few lines are read.
+"""
+
+import os
+import re
+import math
+import cPickle
+import threading
+from array import array
+from bisect import bisect_right
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5: index in this process
+    multiprocessing = None
+
+from markdown_parser import MarkdownParser
+from markdown_loader import read_lines, is_markdown, is_compressed, \
+    FALLBACK_ENCODING
+
+
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+WORD_CHAR = re.compile(r'\w', re.UNICODE)
+
+# Source lines between the byte offsets kept for snippets
+LINE_STEP = 64
+
+_parser = None
+
+
+def plain_text(path, parser):
+    """Return (text, offsets, starts, encoding, num_lines, mtime) for
+    path.
+
+    text is what the viewer would display, as unicode, made of runs
+    beginning at offsets (ascending) that start on the source lines in
+    starts.  encoding and num_lines describe the source, and mtime is the
+    modification time of the file that was read.
+    """
+    line_starts = []
+
+    def parse(lines):
+        return parser.parse_lines(lines, line_starts)
+    segments, lines, st = read_lines(path, parse)
+    pieces = []
+    offsets = array('l')
+    length = 0
+    for text, tags in segments:
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        pieces.append(text)
+        offsets.append(length)
+        length += len(text)
+    return (u''.join(pieces), offsets, line_starts, lines.encoding,
+            lines.count, st.st_mtime)
+
+
+def line_offsets(path, encoding, num_lines):
+    """Return (encoding, offsets): the byte offsets of source lines 1,
+    LINE_STEP + 1, 2 * LINE_STEP + 1, ... of path, or None if its lines
+    can't be found by seeking: it is compressed, in UTF-16, or ends lines
+    with a lone \\r.  encoding and num_lines are as found when it was
+    read."""
+    if is_compressed(path) or encoding not in ('utf-8', FALLBACK_ENCODING):
+        return None
+    offsets = array('l')
+    position = 0
+    newlines = 0
+    f = open(path, 'rb')
+    try:
+        for line in f:
+            if newlines % LINE_STEP == 0:
+                offsets.append(position)
+            position += len(line)
+            if line.endswith('\n'):
+                newlines += 1
+    finally:
+        f.close()
+    if newlines + 1 != num_lines:
+        return None
+    return encoding, offsets
+
+
+def index_file(path):
+    """Return (path, mtime, {term: (count, first offset, first line)},
+    line offsets), or None if path can't be read.
+
+    A module-level function so that a process pool can run it.
+    """
+    global _parser
+    if _parser is None:
+        _parser = MarkdownParser()
+    try:
+        text, offsets, starts, encoding, num_lines, mtime = plain_text(
+            path, _parser)
+        lines = line_offsets(path, encoding, num_lines)
+    except (IOError, OSError):
+        return None
+    counts = {}
+    firsts = {}
+    for match in TERM_PATTERN.finditer(text):
+        term = match.group().lower()
+        if term in counts:
+            counts[term] += 1
+        else:
+            counts[term] = 1
+            firsts[term] = match.start()
+    terms = {}
+    for term, count in counts.iteritems():
+        first = firsts[term]
+        run = bisect_right(offsets, first) - 1
+        line = starts[run] + text.count(u'\n', offsets[run], first)
+        terms[term] = (count, first, line)
+    return path, mtime, terms, lines
+
+
+class SearchHit(object):
+    """A file matching a query, and where in its text to show it: offset
+    into its plain text, and the source line and term found there."""
+
+    def __init__(self, path, score, offset, length, snippet, line=None,
+                 term=None):
+        self.path = path
+        self.score = score
+        self.offset = offset
+        self.length = length
+        self.snippet = snippet
+        self.line = line
+        self.term = term
+
+
+class FolderIndex(object):
+    """An inverted index of the Markdown files under one folder.
+
+    Callers hold lock while loading, updating or searching, since an
+    update may run on a worker thread.
+    """
+
+    VERSION = 3
+    SNIPPET_CONTEXT = 40
+    # Source lines looked through for the term of a snippet, from the
+    # line where it was found (long lines are broken up by the parser)
+    SNIPPET_LINES = 8
+
+    def __init__(self, folder, cache_path):
+        self.folder = folder
+        self.cache_path = cache_path
+        self.mtimes = {}
+        # {term: {path: (count, first offset, first line)}}; each term is
+        # pickled once however many files contain it
+        self.postings = {}
+        # {path: line_offsets() result}
+        self.line_offsets = {}
+        # {path: [term]}, to take a file's terms out again; not saved
+        self.file_terms = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Read the saved index, if any; a stale or damaged one is ignored."""
+        try:
+            f = open(self.cache_path, 'rb')
+        except IOError:
+            return
+        try:
+            try:
+                data = cPickle.load(f)
+            except Exception:
+                return
+        finally:
+            f.close()
+        if data.get('version') != self.VERSION or \
+                data.get('folder') != self.folder:
+            return
+        self.mtimes = data['mtimes']
+        self.postings = data['postings']
+        self.line_offsets = data['line_offsets']
+        self.file_terms = {}
+        for path in self.mtimes:
+            self.file_terms[path] = []
+        for term, paths in self.postings.iteritems():
+            for path in paths:
+                self.file_terms[path].append(term)
+
+    def save(self):
+        data = {'version': self.VERSION, 'folder': self.folder,
+                'mtimes': self.mtimes, 'postings': self.postings,
+                'line_offsets': self.line_offsets}
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            f = open(self.cache_path, 'wb')
+            try:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            pass
+
+    def update(self, processes=None):
+        """Re-index new and modified files and drop deleted ones.
+
+        Returns the number of files that were (re-)indexed.  Parsing is
+        spread over a process pool where multiprocessing is available
+        (Python 2.6 and later), unless processes is 1.  A GUI process must
+        pass 1: the pool forks it, and forking a multithreaded Tk process
+        is not safe on Mac OS X, so there the files are indexed one by one
+        in the calling thread.  viewer.py --build-index runs the pool
+        without a window.
+        """
+        current = {}
+        for directory, dirnames, filenames in os.walk(self.folder):
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.')]
+            for name in filenames:
+                if is_markdown(name):
+                    path = os.path.join(directory, name)
+                    try:
+                        current[path] = os.stat(path).st_mtime
+                    except OSError:
+                        pass
+
+        for path in self.mtimes.keys():
+            if path not in current:
+                self._remove(path)
+        changed = [path for path, mtime in current.iteritems()
+                   if self.mtimes.get(path) != mtime]
+        if not changed:
+            return 0
+
+        if multiprocessing is not None and processes != 1 and \
+                len(changed) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.imap_unordered(index_file, changed, 16)
+                for result in results:
+                    self._add(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for path in changed:
+                self._add(index_file(path))
+        return len(changed)
+
+    def _add(self, result):
+        if result is None:
+            return
+        path, mtime, terms, lines = result
+        self._remove(path)
+        self.mtimes[path] = mtime
+        self.line_offsets[path] = lines
+        self.file_terms[path] = terms.keys()
+        for term, entry in terms.iteritems():
+            self.postings.setdefault(term, {})[path] = entry
+
+    def _remove(self, path):
+        terms = self.file_terms.pop(path, None)
+        if terms is not None:
+            for term in terms:
+                paths = self.postings.get(term)
+                if paths is not None:
+                    paths.pop(path, None)
+                    if not paths:
+                        del self.postings[term]
+        self.mtimes.pop(path, None)
+        self.line_offsets.pop(path, None)
+
+    def search(self, query, limit=50):
+        """Return up to limit SearchHits for files containing every term of
+        query, best first (summed tf-idf)."""
+        if isinstance(query, str):
+            query = query.decode('utf-8', 'replace')
+        terms = [term.lower() for term in TERM_PATTERN.findall(query)]
+        if not terms:
+            return []
+        candidates = None
+        for term in terms:
+            paths = self.postings.get(term)
+            if not paths:
+                return []
+            if candidates is None:
+                candidates = set(paths)
+            else:
+                candidates.intersection_update(paths)
+
+        total = float(len(self.mtimes))
+        weights = {}
+        for term in terms:
+            weights[term] = math.log(1.0 + total / len(self.postings[term]))
+        ranked = []
+        for path in candidates:
+            score = 0.0
+            for term in terms:
+                score += self.postings[term][path][0] * weights[term]
+            ranked.append((score, path))
+        ranked.sort()
+        ranked.reverse()
+
+        # Point each hit at the first occurrence of the rarest term
+        rarest = min([(len(self.postings[term]), term) for term in terms])[1]
+        hits = []
+        for score, path in ranked[:limit]:
+            count, offset, line = self.postings[rarest][path]
+            hits.append(SearchHit(path, score, offset, len(rarest),
+                                  self._snippet(path, rarest), line, rarest))
+        return hits
+
+    def _snippet(self, path, term):
+        """Return the source line of path where term first occurs, cut to
+        SNIPPET_CONTEXT characters either side of it, or u'' if the file
+        can't be read."""
+        line = self.postings[term][path][2]
+        try:
+            lines = self._read_lines(path, line, self.SNIPPET_LINES)
+        except (IOError, OSError):
+            return u''
+        for text in lines:
+            index = _find_term(text, term)
+            if index != -1:
+                break
+        else:
+            # Only in markup the parser rewrote; show the line as it is
+            if not lines:
+                return u''
+            text = lines[0]
+            index = 0
+        start = max(0, index - self.SNIPPET_CONTEXT)
+        end = index + len(term) + self.SNIPPET_CONTEXT
+        snippet = u' '.join(text[start:end].split())
+        if start > 0:
+            snippet = u'…' + snippet
+        if end < len(text):
+            snippet = snippet + u'…'
+        return snippet
+
+    def _read_lines(self, path, first, count):
+        """Return count source lines of path from line first on (1 for the
+        first), seeking to them where the index has the offsets."""
+        offsets = self.line_offsets.get(path)
+        if offsets is None:
+            def take(lines):
+                taken = []
+                for number, text in enumerate(lines):
+                    if number >= first - 1:
+                        taken.append(text)
+                        if len(taken) == count:
+                            break
+                return taken
+            lines, chunked, st = read_lines(path, take)
+            return lines
+        encoding, offsets = offsets
+        step = (first - 1) // LINE_STEP
+        if step >= len(offsets):
+            return []
+        f = open(path, 'rb')
+        try:
+            f.seek(offsets[step])
+            for number in xrange((first - 1) % LINE_STEP):
+                f.readline()
+            lines = []
+            for number in xrange(count):
+                data = f.readline()
+                if not data:
+                    break
+                lines.append(data.rstrip('\r\n').decode(encoding, 'replace'))
+        finally:
+            f.close()
+        if first == 1 and lines:
+            lines[0] = lines[0].lstrip(u'\ufeff')
+        return lines
+
+
+def _find_term(text, term):
+    """Return the offset of the first whole-word, case-insensitive
+    occurrence of the lower-case term in text, or -1."""
+    # lower() keeps the offsets of unicode text
+    lowered = text.lower()
+    index = lowered.find(term)
+    while index != -1:
+        after = index + len(term)
+        if (index == 0 or not WORD_CHAR.match(text, index - 1)) and \
+                not WORD_CHAR.match(text, after):
+            return index
+        index = lowered.find(term, index + 1)
+    return -1
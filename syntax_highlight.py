@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lightweight regex lexers for fenced code blocks.
+
+highlight(language, code) returns {token: [(start, end), ...]} with
+character offsets into code, where token is one of 'keyword', 'string',
+'comment', 'number' or 'variable'.  Only the token kinds that matter for
+reading are recognised; everything else is left as plain code.
+"""
+
+import re
+
+
+def _lexer(rules, flags=0):
+    """Combine (token, pattern) rules into one alternation; earlier rules
+    win where they overlap at the same position."""
+    return re.compile('|'.join(['(?P<%s>%s)' % rule for rule in rules]),
+                      flags)
+
+
+def _words(words):
+    return r'\b(?:%s)\b' % '|'.join(words.split())
+
+
+PYTHON = _lexer([
+    ('comment', r'#[^\n]*'),
+    ('string', r'[rRuUbB]{0,2}(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\''
+               r'|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')'),
+    ('keyword', _words('and as assert break class continue def del elif '
+                       'else except exec finally for from global if import '
+                       'in is lambda not or pass print raise return try '
+                       'while with yield None True False self')),
+    ('number', r'\b(?:0[xX][0-9a-fA-F]+|\d+\.?\d*(?:[eE][+-]?\d+)?)'
+               r'[jJlL]?\b'),
+])
+
+SHELL = _lexer([
+    ('comment', r'(?:^|(?<=\s))#[^\n]*'),
+    ('string', r'"(?:\\.|[^"\\])*"|\'[^\']*\''),
+    ('variable', r'\$(?:\{[^}\n]*\}|\w+|[@*#?$!0-9])'),
+    ('keyword', _words('if then else elif fi for while until do done case '
+                       'esac function in return export local set unset '
+                       'source alias exit')),
+    ('number', r'\b\d+\b'),
+], re.MULTILINE)
+
+JSON = _lexer([
+    ('string', r'"(?:\\.|[^"\\\n])*"'),
+    ('keyword', _words('true false null')),
+    ('number', r'-?\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b'),
+])
+
+C = _lexer([
+    ('comment', r'//[^\n]*|/\*[\s\S]*?\*/'),
+    ('string', r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])+\''),
+    ('keyword', r'^[ \t]*#[ \t]*\w+|' +
+                _words('auto break case char const continue default do '
+                       'double else enum extern float for goto if inline '
+                       'int long register restrict return short signed '
+                       'sizeof static struct switch typedef union unsigned '
+                       'void volatile while NULL')),
+    ('number', r'\b(?:0[xX][0-9a-fA-F]+|\d+\.?\d*(?:[eE][+-]?\d+)?)'
+               r'[uUlLfF]*\b'),
+], re.MULTILINE)
+
+LEXERS = {
+    'python': PYTHON, 'py': PYTHON, 'python2': PYTHON,
+    'sh': SHELL, 'bash': SHELL, 'shell': SHELL, 'zsh': SHELL,
+    'console': SHELL,
+    'json': JSON,
+    'c': C, 'h': C, 'objc': C, 'objective-c': C,
+}
+
+
+def supports(language):
+    return language in LEXERS
+
+
+def highlight(language, code):
+    """Return {token: [(start, end), ...]} for code in language."""
+    ranges = {}
+    lexer = LEXERS.get(language)
+    if lexer is None:
+        return ranges
+    for match in lexer.finditer(code):
+        ranges.setdefault(match.lastgroup, []).append(
+            (match.start(), match.end()))
+    return ranges
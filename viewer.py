@@ -5,55 +5,1317 @@ Markdown Viewer for PowerPC Mac
 A lightweight Markdown viewer built with Tkinter for Mac OS X 10.5 / Python 2.5.
 
 Usage:
-    python viewer.py [file.md]
+    python viewer.py [--profile-startup] [file.md]
 """
 
+import time
+_LAUNCH_TIME = time.time()
+
 import sys
 import os
+import errno
+import base64
+import hashlib
+import optparse
+import socket
+import stat
+import struct
+import threading
+import urllib
+import ConfigParser
+import Queue
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
 import Tkinter as tk
 import tkFont
-import tkFileDialog
-import tkMessageBox
 from markdown_parser import MarkdownParser
+from markdown_loader import read_markdown, read_page, stat_path, is_file, \
+    is_markdown, is_archive, is_compressed, split_archive_path, list_archive
+from search_index import FolderIndex
+import syntax_highlight
 
 
-class MarkdownViewer(object):
-    """Main application window for the Markdown Viewer."""
+CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.markdown_viewer')
 
-    APP_NAME = "Markdown Viewer"
-    WINDOW_WIDTH = 720
-    WINDOW_HEIGHT = 580
-    BG_COLOR = "#FEFEFE"
-    TEXT_COLOR = "#1A1A1A"
-    ACCENT_COLOR = "#2860A0"
-    CODE_BG = "#F0F0F0"
-    BLOCKQUOTE_COLOR = "#555555"
-    HR_COLOR = "#CCCCCC"
-
-    def __init__(self, root, filepath=None):
-        self.root = root
-        self.parser = MarkdownParser()
-        self.current_file = None
+# Where the bundled data files (themes.cfg) are installed
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 
-        self._setup_window()
-        self._setup_fonts()
-        self._setup_menu()
-        self._setup_ui()
-        self._setup_tags()
-        self._bind_keys()
 
-        if filepath and os.path.isfile(filepath):
-            self.open_file(filepath)
+def _read_config(name):
+    """Load a config file from CONFIG_DIR; missing files read as empty."""
+    config = ConfigParser.RawConfigParser()
+    try:
+        config.read([os.path.join(CONFIG_DIR, name)])
+    except ConfigParser.Error:
+        pass
+    return config
+
+
+def _write_config(name, config):
+    """Save a config file into CONFIG_DIR, ignoring unwritable homes."""
+    try:
+        if not os.path.isdir(CONFIG_DIR):
+            os.makedirs(CONFIG_DIR)
+        f = open(os.path.join(CONFIG_DIR, name), 'w')
+        try:
+            config.write(f)
+        finally:
+            f.close()
+    except (IOError, OSError):
+        pass
+
+
+def _index_path(folder):
+    """Where the search index of folder is saved."""
+    if isinstance(folder, unicode):
+        folder = folder.encode('utf-8')
+    return os.path.join(CONFIG_DIR,
+                        'index-%s.pickle' % hashlib.md5(folder).hexdigest())
+
+
+INSTANCE_SOCKET = os.path.join(CONFIG_DIR, 'instance.sock')
+
+
+def send_to_running_instance(paths):
+    """Hand paths to a viewer already listening on INSTANCE_SOCKET.
+
+    Returns False if no instance accepted them, including when the
+    socket file was left behind by one that crashed.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(INSTANCE_SOCKET)
+            sock.sendall(''.join([os.path.abspath(path) + '\n'
+                                  for path in paths]))
+        except socket.error:
+            return False
+    finally:
+        sock.close()
+    return True
+
+
+def remove_stale_socket():
+    """Remove INSTANCE_SOCKET if nothing is listening on it any more.
+
+    Only a refused connection marks the file as stale; any other error
+    may be passing, and the viewer that owns the file keeps it.  The
+    file is unlinked only if it is still the one that refused, so a
+    viewer that has just bound the path in the meantime keeps it too.
+    Returns True if the file was removed.
+    """
+    try:
+        inode = os.stat(INSTANCE_SOCKET).st_ino
+    except OSError:
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(INSTANCE_SOCKET)
+        except socket.error, e:
+            if e.args[0] != errno.ECONNREFUSED:
+                return False
         else:
-            self._show_welcome()
+            return False
+    finally:
+        sock.close()
+    try:
+        if os.stat(INSTANCE_SOCKET).st_ino != inode:
+            return False
+        os.unlink(INSTANCE_SOCKET)
+    except OSError:
+        return False
+    return True
+
+
+class InstanceServer(object):
+    """Accepts paths from later launches and hands them to a callback.
+
+    Each connection carries zero or more newline-terminated paths; an
+    empty one just asks the running viewer to come to the front.  The
+    socket is bound as soon as the options are parsed, so a launch
+    that comes while the window is still being built queues up in the
+    listen backlog; attach() starts serving it once Tk is running.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.callback = None
+        self.sock = None
+        self.inode = None
+        # Open connections -> the chunks read from them so far
+        self.connections = {}
+
+    def bind(self):
+        """Claim INSTANCE_SOCKET; returns False if it can't be bound,
+        usually because the path is already taken."""
+        if not hasattr(socket, 'AF_UNIX'):
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if not os.path.isdir(CONFIG_DIR):
+                os.makedirs(CONFIG_DIR)
+            sock.bind(INSTANCE_SOCKET)
+            sock.listen(5)
+            # Remembered so that close() removes only the file made here
+            self.inode = os.stat(INSTANCE_SOCKET).st_ino
+        except (socket.error, OSError):
+            sock.close()
+            return False
+        sock.setblocking(0)
+        self.sock = sock
+        return True
+
+    def attach(self, root, callback):
+        """Start handing connections to callback from root's event loop."""
+        self.root = root
+        self.callback = callback
+        root.tk.createfilehandler(self.sock, tk.READABLE, self._on_readable)
 
-    def _setup_window(self):
-        self.root.title(self.APP_NAME)
-        self.root.geometry("%dx%d" % (self.WINDOW_WIDTH, self.WINDOW_HEIGHT))
-        self.root.minsize(400, 300)
-        self.root.configure(bg=self.BG_COLOR)
+    def _on_readable(self, sock, mask):
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error:
+            return
+        # Read as data arrives rather than waiting on a slow sender
+        conn.setblocking(0)
+        self.connections[conn] = []
+        self.root.tk.createfilehandler(conn, tk.READABLE, self._on_data)
+
+    def _on_data(self, conn, mask):
+        try:
+            data = conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            # A broken connection may have cut a path short; drop it all
+            self._drop(conn)
+            return
+        if data:
+            self.connections[conn].append(data)
+            return
+        chunks = self._drop(conn)
+        paths = [line for line in ''.join(chunks).split('\n') if line]
+        self.callback(paths)
+
+    def _drop(self, conn):
+        """Stop reading conn and close it; returns what it sent."""
+        self.root.tk.deletefilehandler(conn)
+        conn.close()
+        return self.connections.pop(conn)
+
+    def close(self):
+        if self.sock is None:
+            return
+        if self.root is not None:
+            for conn in self.connections.keys():
+                self._drop(conn)
+            self.root.tk.deletefilehandler(self.sock)
+        self.sock.close()
+        self.sock = None
+        # Another viewer may have taken the path over since
+        try:
+            if os.stat(INSTANCE_SOCKET).st_ino == self.inode:
+                os.unlink(INSTANCE_SOCKET)
+        except OSError:
+            pass
+
+
+class Document(object):
+    """A markdown file read from disk and parsed into segments.
+
+    Of a file shown a page at a time, pages is its PageTable and the
+    segments are those of page page; line_starts then holds the source
+    line of each segment.  pages is None for a file read whole.
+    """
+
+    def __init__(self, path, segments, num_lines, file_size, mtime=None,
+                 pages=None, page=0, line_starts=None):
+        self.path = path
+        self.segments = segments
+        self.num_lines = num_lines
+        self.file_size = file_size
+        self.mtime = mtime
+        self.pages = pages
+        self.page = page
+        self.line_starts = line_starts
+        # Lines the parser broke up and left unformatted
+        self.long_lines = len([tags for text, tags in segments
+                               if 'long_line' in tags])
+
+
+def load_document(filepath, parser, page=0):
+    """Read and parse a markdown file, or page page of one too large to
+    read whole (see markdown_loader.page_table()).
+
+    Touches no Tk state, so it is safe to call from a worker thread.
+    """
+    starts = []
+    paged = read_page(filepath, parser, page, starts)
+    if paged is not None:
+        segments, table, page = paged
+        return Document(filepath, segments, table.num_lines, table.size,
+                        table.mtime, table, page, array('l', starts))
+    segments, num_lines, st = read_markdown(filepath, parser)
+    return Document(filepath, segments, num_lines, st.st_size, st.st_mtime)
+
+
+class _LRU(object):
+    """A least-recently-used mapping bounded by the total size of its values.
+
+    Each value is put with a size, 1 unless given, so the same class
+    bounds a cache by entry count or by bytes.  A value larger than the
+    whole budget is not cached.  Not thread-safe.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = {}
+        self._clock = 0
+        self._total = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._clock += 1
+        entry[2] = self._clock
+        return entry[0]
+
+    def put(self, key, value, size=1):
+        if size > self.capacity:
+            return
+        old = self._entries.get(key)
+        if old is not None:
+            self._total -= old[1]
+        self._clock += 1
+        self._entries[key] = [value, size, self._clock]
+        self._total += size
+        while self._total > self.capacity:
+            oldest = min([(entry[2], old_key) for old_key, entry
+                          in self._entries.items()])[1]
+            self._total -= self._entries.pop(oldest)[1]
+
+
+class DocumentCache(object):
+    """A thread-safe LRU of parsed documents, bounded by total file size."""
+
+    def __init__(self, max_bytes):
+        self._lock = threading.Lock()
+        self._documents = _LRU(max_bytes)
+
+    def get(self, path):
+        """Return the cached document for path if the file is unchanged."""
+        key = os.path.abspath(path)
+        self._lock.acquire()
+        try:
+            document = self._documents.get(key)
+        finally:
+            self._lock.release()
+        if document is None:
+            return None
+        try:
+            if stat_path(key).st_mtime != document.mtime:
+                return None
+        except OSError:
+            return None
+        return document
+
+    def put(self, document):
+        if document.pages is not None:
+            # One page of many; it is read again when wanted
+            return
+        key = os.path.abspath(document.path)
+        self._lock.acquire()
+        try:
+            self._documents.put(key, document, document.file_size)
+        finally:
+            self._lock.release()
+
+
+class PreloadThread(threading.Thread):
+    """Loads a document in the background while the window is built."""
+
+    def __init__(self, filepath, parser):
+        threading.Thread.__init__(self, name="preload")
+        self.setDaemon(True)
+        self.filepath = filepath
+        self.parser = parser
+        self.document = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.document = load_document(self.filepath, self.parser)
+        except Exception, e:
+            self.error = e
+
+    def result(self):
+        """Wait for the load to finish; return the document or re-raise."""
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.document
+
+
+class Prefetcher(threading.Thread):
+    """Parses documents the user is likely to open next into a cache.
+
+    Candidates are the local files the current document links to and
+    the recently opened files.  The thread only works while Tk is idle:
+    hold() is called on the main thread before foreground loading or
+    rendering and lifts itself from an after_idle callback.  After each
+    file it sleeps long enough to stay within its share of one CPU.
+    """
+
+    MAX_PENDING = 32
+
+    # Larger files are left alone: a parse can't be interrupted, so this
+    # bounds how long foreground work may wait for the thread.  It is
+    # compared with the uncompressed size, so .gz and .bz2 files, whose
+    # size isn't known before they are read, are left alone too.
+    MAX_FILE_BYTES = 512 * 1024
+
+    def __init__(self, root, documents, parser, share):
+        threading.Thread.__init__(self, name="prefetch")
+        self.setDaemon(True)
+        self.root = root
+        self.documents = documents
+        self.parser = parser
+        self.share = share
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._release_scheduled = False
+
+    def request(self, paths):
+        """Queue paths, the first most urgent, ahead of older requests."""
+        self._lock.acquire()
+        try:
+            for path in reversed(paths):
+                try:
+                    self._pending.remove(path)
+                except ValueError:
+                    pass
+                self._pending.appendleft(path)
+            while len(self._pending) > self.MAX_PENDING:
+                self._pending.pop()
+            if self._pending:
+                self._wakeup.set()
+        finally:
+            self._lock.release()
+
+    def hold(self):
+        """Keep the thread paused until Tk has run out of work."""
+        self._idle.clear()
+        if not self._release_scheduled:
+            self._release_scheduled = True
+            self.root.after_idle(self._release)
+
+    def _release(self):
+        self._release_scheduled = False
+        self._idle.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            self._idle.wait()
+            self._lock.acquire()
+            try:
+                if not self._pending:
+                    self._wakeup.clear()
+                    continue
+                path = self._pending.popleft()
+            finally:
+                self._lock.release()
+            started = time.time()
+            self._prefetch(path)
+            elapsed = time.time() - started
+            time.sleep(elapsed * (1.0 - self.share) / self.share)
+
+    def _prefetch(self, path):
+        if is_compressed(path):
+            return
+        try:
+            st = stat_path(path)
+        except OSError:
+            return
+        if not stat.S_ISREG(st.st_mode) or st.st_size > self.MAX_FILE_BYTES:
+            return
+        if self.documents.get(path) is not None:
+            return
+        try:
+            document = load_document(path, self.parser)
+        except Exception:
+            # Left for open_file to report if the user opens it
+            return
+        self.documents.put(document)
+
+
+class _TkWorker(threading.Thread):
+    """A worker thread whose results are delivered on the Tk thread.
+
+    submit() is called on the Tk thread and work() runs on the worker.
+    Results come back through a queue that the Tk thread polls while
+    requests are outstanding, since only that thread may touch Tk.
+    """
+
+    POLL_MS = 50
+
+    def __init__(self, root, name):
+        threading.Thread.__init__(self, name=name)
+        self.setDaemon(True)
+        self.root = root
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._outstanding = 0
+
+    def submit(self, request, callback):
+        """Run work(request) in the background and call
+        callback(request, result) on the Tk thread."""
+        self._requests.put((request, callback))
+        self._outstanding += 1
+        if self._outstanding == 1:
+            self.root.after(self.POLL_MS, self._poll)
+
+    def _poll(self):
+        while True:
+            try:
+                request, callback, result = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            self._outstanding -= 1
+            callback(request, result)
+        if self._outstanding:
+            self.root.after(self.POLL_MS, self._poll)
+
+    def run(self):
+        while True:
+            request, callback = self._requests.get()
+            self._results.put((request, callback, self.work(request)))
+
+    def work(self, request):
+        """Return the result for request; runs on the worker thread.
+
+        Subclasses override this with the job they run in the background.
+        """
+        raise NotImplementedError
+
+
+class DirectoryScanner(_TkWorker):
+    """Lists directories on a worker thread, caching listings by mtime.
+
+    A cached listing is reused as long as the directory's mtime is
+    unchanged.  Zip archives are listed like directories.
+    """
+
+    def __init__(self, root):
+        _TkWorker.__init__(self, root, "scanner")
+        self._lock = threading.Lock()
+        self._cache = {}
+
+    def cached(self, path):
+        """Return the last listing of path, which may be stale, or None."""
+        self._lock.acquire()
+        try:
+            entry = self._cache.get(path)
+        finally:
+            self._lock.release()
+        if entry is None:
+            return None
+        return entry[1]
+
+    def scan(self, path, callback):
+        """List path in the background and call callback(path, entries)
+        on the Tk thread; entries is None if path can't be read."""
+        self.submit(path, callback)
+
+    def work(self, path):
+        archive, member = split_archive_path(path)
+        if archive is not None:
+            # The archive keeps its own cached directory
+            return list_archive(archive, member)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        self._lock.acquire()
+        try:
+            entry = self._cache.get(path)
+        finally:
+            self._lock.release()
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return None
+        entries = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path) or is_archive(full_path):
+                entries.append((0, name.lower(), name, True))
+            elif is_markdown(name):
+                entries.append((1, name.lower(), name, False))
+        entries.sort()
+        entries = [(name, is_dir) for order, key, name, is_dir in entries]
+        self._lock.acquire()
+        try:
+            self._cache[path] = (mtime, entries)
+        finally:
+            self._lock.release()
+        return entries
+
+
+def _image_size(data):
+    """Return (width, height) from the header of a GIF or PNG, or None."""
+    if data[:6] in ('GIF87a', 'GIF89a') and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    if data[:8] == '\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>LL', data[16:24])
+    return None
+
+
+class ImageReader(_TkWorker):
+    """Reads image files for PhotoImage on a worker thread.
+
+    Tk decodes images only on its own thread, so the worker does the file
+    I/O and the base64 encoding that PhotoImage(data=...) expects.  The
+    result is (mtime, data), or None if the file can't be read or is too
+    big to decode without stalling the window; such images stay shown as
+    their placeholder text.
+    """
+
+    MAX_BYTES = 4 * 1024 * 1024
+    # Decoding is what blocks the Tk thread, and it scales with pixels
+    MAX_PIXELS = 4 * 1024 * 1024
+
+    def __init__(self, root):
+        _TkWorker.__init__(self, root, "images")
+
+    def work(self, path):
+        try:
+            f = open(path, 'rb')
+            try:
+                st = os.fstat(f.fileno())
+                if st.st_size > self.MAX_BYTES:
+                    return None
+                content = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+        size = _image_size(content)
+        if size is not None and size[0] * size[1] > self.MAX_PIXELS:
+            return None
+        return st.st_mtime, base64.b64encode(content)
+
+
+class CodeHighlighter(_TkWorker):
+    """Runs the syntax highlighter for code blocks on a worker thread.
+
+    Requests are (key, language, code); the result is the token ranges
+    from syntax_highlight.highlight().
+    """
+
+    def __init__(self, root):
+        _TkWorker.__init__(self, root, "highlighter")
+
+    def work(self, request):
+        key, language, code = request
+        return syntax_highlight.highlight(language, code)
+
+
+class _ImageCache(_LRU):
+    """An LRU of scaled PhotoImages, bounded by their size in bytes.
+
+    Used on the Tk thread only.  Images shown in a text widget are also
+    referenced by their tab, so eviction only drops the cached copy.
+    """
+
+    def put(self, key, image):
+        _LRU.put(self, key, image, image.width() * image.height() * 4)
+
+
+def _compact_segments(segments):
+    """Return segments with equal tag lists shared as a single tuple."""
+    shared = {}
+    compact = []
+    for text_content, tags in segments:
+        key = tuple(tags)
+        compact.append((text_content, shared.setdefault(key, key)))
+    return compact
+
+
+class _HistoryEntry(object):
+    """A place to return to with Back/Forward: file, page, scroll and
+    folds."""
+
+    __slots__ = ('path', 'page', 'yview', 'fold_state')
+
+    def __init__(self, path, page, yview, fold_state):
+        self.path = path
+        self.page = page
+        self.yview = yview
+        self.fold_state = fold_state
+
+
+class _Tab(object):
+    """One open document: its parse, fold state and, while live, widget.
+
+    A hibernated tab has text=None and keeps only its compacted segments,
+    scroll position and fold state, from which it is re-rendered when
+    shown again.
+    """
+
+    def __init__(self, path, document=None, preload=None):
+        self.path = path
+        self.document = document
+        self.preload = preload
+        self.text = None
+        self.sections = []
+        self.heading_lines = []
+        self.heading_sections = []
+        self.link_lines = []
+        self.link_sections = []
+        self.images = []
+        self.pending_font_tags = None
+        self.font_zoom = None
+        self.fold_state = None
+        self.yview = 0.0
+        self.last_active = 0
+        self.button = None
+        self.back = []
+        self.forward = []
+
+
+class _PeerText(tk.Text):
+    """A Tk 8.5 peer of another Text widget.
+
+    The peer shows the same text storage, tags and marks as the widget it
+    was created from but scrolls independently; only the view is extra.
+    tk.Text.__init__ would create an unrelated widget, so the Tk side is
+    made with 'peer create' and then wrapped.
+    """
+
+    def __init__(self, master, peer_of, **kw):
+        tk.BaseWidget._setup(self, master, {'name': 'peer%d' % id(self)})
+        self.tk.call(peer_of._w, 'peer', 'create', self._w,
+                     *self._options(kw))
+
+
+class _FolderRow(object):
+    """One line of the folder tree; a placeholder while path is None."""
+
+    __slots__ = ('path', 'depth', 'is_dir')
+
+    def __init__(self, path, depth, is_dir):
+        self.path = path
+        self.depth = depth
+        self.is_dir = is_dir
+
+
+class FolderBrowser(object):
+    """A sidebar tree of the markdown files under one folder.
+
+    Every row lives in a single Listbox, indented by depth.  A directory
+    is listed only when it is expanded; its cached listing is shown at
+    once and replaced if the scanner finds that it changed.
+    """
+
+    INDENT = u'    '
+    OPEN_MARKER = u'\u25be '
+    CLOSED_MARKER = u'\u25b8 '
+    FILE_MARKER = u'  '
+
+    def __init__(self, master, scanner, open_file, font):
+        self.scanner = scanner
+        self.open_file = open_file
+        self.root_path = None
+        self.rows = []
+        self.expanded = set()
+
+        self.frame = tk.Frame(master)
+        scrollbar = tk.Scrollbar(self.frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self.frame, font=font, width=28,
+                                  relief=tk.FLAT, highlightthickness=0,
+                                  exportselection=False,
+                                  yscrollcommand=scrollbar.set)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=self.listbox.yview)
+        self.listbox.bind('<ButtonRelease-1>', self._on_click)
+        self.listbox.bind('<Return>', self._on_return)
+
+    def set_root(self, path):
+        """Show the tree of path, dropping the previous one."""
+        self.root_path = path
+        self.expanded = set()
+        self.rows = []
+        self.listbox.delete(0, tk.END)
+        self._show_children(-1, path, 0)
+
+    def _on_click(self, event):
+        index = self.listbox.nearest(event.y)
+        if 0 <= index < len(self.rows):
+            self._activate(index)
+
+    def _on_return(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self._activate(int(selection[0]))
+
+    def _activate(self, index):
+        row = self.rows[index]
+        if row.path is None:
+            return
+        if not row.is_dir:
+            self.open_file(row.path)
+        elif row.path in self.expanded:
+            self.expanded.discard(row.path)
+            self._remove_children(index)
+            self._relabel(index)
+        else:
+            self.expanded.add(row.path)
+            self._relabel(index)
+            self._show_children(index, row.path, row.depth + 1)
+
+    def _label(self, row):
+        name = os.path.basename(row.path)
+        if isinstance(name, str):
+            name = name.decode('utf-8', 'replace')
+        if not row.is_dir:
+            marker = self.FILE_MARKER
+        elif row.path in self.expanded:
+            marker = self.OPEN_MARKER
+        else:
+            marker = self.CLOSED_MARKER
+        return self.INDENT * row.depth + marker + name
+
+    def _relabel(self, index):
+        self.listbox.delete(index)
+        self.listbox.insert(index, self._label(self.rows[index]))
+
+    def _show_children(self, index, path, depth):
+        """Fill in the children of the directory row at index (-1 for the
+        root) from the cache, and have the scanner revalidate them."""
+        entries = self.scanner.cached(path)
+        if entries is None:
+            self.rows.insert(index + 1, _FolderRow(None, depth, False))
+            self.listbox.insert(index + 1,
+                                self.INDENT * depth + u'Loading\u2026')
+        else:
+            self._insert_children(index, path, depth, entries)
+        self.scanner.scan(path, self._on_scanned)
+
+    def _insert_children(self, index, path, depth, entries):
+        rows = [_FolderRow(os.path.join(path, name), depth, is_dir)
+                for name, is_dir in entries]
+        self.rows[index + 1:index + 1] = rows
+        if rows:
+            self.listbox.insert(index + 1,
+                                *[self._label(row) for row in rows])
+        # Subdirectories that were open before are opened again
+        position = index + 1
+        for row in rows:
+            position = self.rows.index(row, position)
+            if row.is_dir and row.path in self.expanded:
+                self._show_children(position, row.path, depth + 1)
+
+    def _remove_children(self, index):
+        """Remove the rows below the row at index (-1 for the root)."""
+        if index < 0:
+            depth = -1
+        else:
+            depth = self.rows[index].depth
+        stop = index + 1
+        while stop < len(self.rows) and self.rows[stop].depth > depth:
+            stop += 1
+        if stop > index + 1:
+            del self.rows[index + 1:stop]
+            self.listbox.delete(index + 1, stop - 1)
+
+    def _on_scanned(self, path, entries):
+        if not self.listbox.winfo_exists():
+            return
+        if path == self.root_path:
+            index = -1
+            depth = 0
+        else:
+            if path not in self.expanded:
+                return
+            for index, row in enumerate(self.rows):
+                if row.path == path:
+                    break
+            else:
+                return
+            depth = self.rows[index].depth + 1
+        children = [(os.path.basename(row.path), row.is_dir)
+                    for row in self.rows[index + 1:]
+                    if row.depth == depth and row.path is not None
+                    and os.path.dirname(row.path) == path]
+        placeholder = (index + 1 < len(self.rows) and
+                       self.rows[index + 1].path is None)
+        if entries is None:
+            entries = []
+        if children == entries and not placeholder:
+            return
+        self._remove_children(index)
+        self._insert_children(index, path, depth, entries)
+
+
+class SearchDialog(object):
+    """A window for searching every markdown file under a folder.
+
+    The folder's index is loaded from disk and brought up to date on a
+    worker thread; queries are only run once that has finished.
+    """
+
+    POLL_MS = 100
+
+    def __init__(self, master, index, open_hit, font):
+        self.index = index
+        self.open_hit = open_hit
+        self.hits = []
+        self.ready = False
+
+        self.window = tk.Toplevel(master)
+        self.window.title("Search %s" % os.path.basename(index.folder))
+        self.window.geometry("560x420")
+
+        self.entry = tk.Entry(self.window, font=font)
+        self.entry.pack(fill=tk.X, padx=8, pady=8)
+        self.entry.bind('<Return>', lambda e: self._search())
+        self.entry.bind('<Escape>', lambda e: self.window.destroy())
+
+        self.results = tk.Listbox(self.window, font=font,
+                                  relief=tk.FLAT, highlightthickness=0,
+                                  exportselection=False)
+        self.results.pack(fill=tk.BOTH, expand=True, padx=8)
+        self.results.bind('<Double-Button-1>', self._on_open)
+        self.results.bind('<Return>', self._on_open)
+
+        self.status = tk.Label(self.window, text="Indexing...", anchor=tk.W,
+                               font=font)
+        self.status.pack(fill=tk.X, padx=8, pady=4)
+        self.entry.focus_set()
+
+        self._update_error = None
+        self._updated = 0
+        self._thread = threading.Thread(target=self._update,
+                                        name="indexer")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self.window.after(self.POLL_MS, self._poll)
+
+    def _update(self):
+        self.index.lock.acquire()
+        try:
+            try:
+                if not self.index.mtimes:
+                    self.index.load()
+                # Serially: forking the running Tk process isn't safe
+                self._updated = self.index.update(processes=1)
+                if self._updated:
+                    self.index.save()
+            except Exception, e:
+                self._update_error = e
+        finally:
+            self.index.lock.release()
+
+    def _poll(self):
+        if self._thread.isAlive():
+            self.window.after(self.POLL_MS, self._poll)
+            return
+        if self._update_error is not None:
+            self.status.config(text="Indexing failed: %s" %
+                               self._update_error)
+            return
+        self.ready = True
+        self.status.config(text="%d files indexed (%d updated)" %
+                           (len(self.index.mtimes), self._updated))
+        if self.entry.get():
+            self._search()
+
+    def _search(self):
+        if not self.ready:
+            return
+        # Another window may be updating the same index
+        if not self.index.lock.acquire(False):
+            self.status.config(text="Indexing...")
+            return
+        try:
+            started = time.time()
+            self.hits = self.index.search(self.entry.get())
+            elapsed = (time.time() - started) * 1000
+        finally:
+            self.index.lock.release()
+        self.results.delete(0, tk.END)
+        if self.hits:
+            self.results.insert(0, *[
+                u'%s: %s' % (os.path.basename(hit.path), hit.snippet)
+                for hit in self.hits])
+        self.status.config(text="%d files  |  %.1f ms" %
+                           (len(self.hits), elapsed))
+
+    def _on_open(self, event):
+        selection = self.results.curselection()
+        if selection:
+            self.open_hit(self.hits[int(selection[0])])
+
+
+class _FontSet(object):
+    """The fonts for one zoom level, each created on first lookup."""
+
+    def __init__(self, specs, family, mono_family, size_for):
+        self.specs = specs
+        self.family = family
+        self.mono_family = mono_family
+        self.size_for = size_for
+        self._fonts = {}
+
+    def __getitem__(self, name):
+        font = self._fonts.get(name)
+        if font is None:
+            mono, offset, weight, slant = self.specs[name]
+            if mono:
+                family = self.mono_family
+            else:
+                family = self.family
+            font = tkFont.Font(family=family, size=self.size_for(offset),
+                               weight=weight, slant=slant)
+            self._fonts[name] = font
+        return font
+
+
+class _Section(object):
+    """A heading and the segments that follow it up to the next heading."""
+
+    __slots__ = ('level', 'heading', 'body', 'body_lines', 'collapsed',
+                 'links')
+
+    def __init__(self, level, heading):
+        self.level = level
+        self.heading = heading
+        self.body = []
+        self.body_lines = 0
+        self.collapsed = False
+        self.links = None
+
+
+class _LinkIndex(object):
+    """The links of one section body, sorted by position.
+
+    Positions are (line, column) relative to the start of the body, so the
+    index stays valid when sections above it are folded or unfolded.
+    Plain arrays keep pages with thousands of links small and let a
+    pointer position be resolved with two bisections.
+    """
+
+    __slots__ = ('lines', 'starts', 'ends', 'urls')
+
+    def __init__(self):
+        self.lines = array('l')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.urls = []
+
+    def add(self, line, start, end, url):
+        self.lines.append(line)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.urls.append(url)
+
+    def find(self, line, column):
+        """Return the URL of the link covering (line, column), or None."""
+        lo = bisect_left(self.lines, line)
+        hi = bisect_right(self.lines, line, lo)
+        pos = bisect_right(self.starts, column, lo, hi) - 1
+        if pos >= lo and column < self.ends[pos]:
+            return self.urls[pos]
+        return None
+
+
+def _char_len(s):
+    """Length of s in characters, as Tk counts text columns."""
+    if isinstance(s, str):
+        try:
+            return len(s.decode('utf-8'))
+        except UnicodeError:
+            pass
+    return len(s)
+
+
+class ViewerSession(object):
+    """State shared by every viewer window on one Tk root.
+
+    The parser, fonts and parse caches live here so that another window
+    costs only its own widgets and documents.
+    """
+
+    BASE_FONT_SIZE = 13
+    MIN_FONT_SIZE = 8
+
+    # Font name -> (monospace, size offset from base, weight, slant)
+    FONT_SPECS = {
+        'normal': (False, 0, "normal", "roman"),
+        'bold': (False, 0, "bold", "roman"),
+        'italic': (False, 0, "normal", "italic"),
+        'bold_italic': (False, 0, "bold", "italic"),
+        'h1': (False, 13, "bold", "roman"),
+        'h2': (False, 9, "bold", "roman"),
+        'h3': (False, 5, "bold", "roman"),
+        'h4': (False, 3, "bold", "roman"),
+        'h5': (False, 1, "bold", "roman"),
+        'h6': (False, 0, "bold", "roman"),
+        'code': (True, -1, "normal", "roman"),
+        'code_block': (True, -1, "normal", "roman"),
+        'code_bold': (True, -1, "bold", "roman"),
+    }
+
+    FONT_CACHE = 'fonts.cfg'
+
+    # Total size of the parsed documents kept for Back/Forward and reopening
+    DOCUMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+    # Decoded size of the inline images kept for reuse
+    IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+    # Highlighted code blocks remembered by content hash
+    HIGHLIGHT_CACHE_ENTRIES = 1000
+
+    RECENT_FILES = 'recent.cfg'
+    MAX_RECENT = 10
+
+    # Colour themes come from APP_DIR, then CONFIG_DIR, under this name
+    THEME_FILE = 'themes.cfg'
+    SETTINGS = 'settings.cfg'
+    DEFAULT_THEME_NAME = 'light'
+
+    # The light theme, the only copy of it; colours missing from a theme
+    # are taken from here
+    DEFAULT_THEME = {
+        'background': "#FEFEFE",
+        'text': "#1A1A1A",
+        'accent': "#2860A0",
+        'code_background': "#F0F0F0",
+        'code_inline': "#C7254E",
+        'blockquote': "#555555",
+        'h6': "#444444",
+        'hr': "#CCCCCC",
+        'link_url': "#888888",
+        'image_icon': "#D4882A",
+        'find_highlight': "#FFFF00",
+        'find_current': "#FF9632",
+        'find_text': "#000000",
+        'toolbar': "#E8E8E8",
+        'toolbar_text': "#666666",
+        'file_text': "#333333",
+        'tabbar': "#D0D0D0",
+        'tab_text': "#333333",
+        'statusbar': "#E0E0E0",
+        'status_text': "#888888",
+        'findbar': "#E8E8D8",
+        'findbar_text': "#333333",
+        'sidebar': "#FFFFFF",
+        'sidebar_text': "#000000",
+        'code_keyword': "#A626A4",
+        'code_string': "#50A14F",
+        'code_comment': "#A0A1A7",
+        'code_number': "#986801",
+        'code_variable': "#E45649",
+    }
+
+    # Default share of one CPU the background prefetcher may use
+    PREFETCH_SHARE = 0.25
+
+    def __init__(self, root, parser=None, prefetch_share=PREFETCH_SHARE):
+        self.root = root
+        if parser is None:
+            parser = MarkdownParser()
+        self.parser = parser
+        self.windows = []
+        self.family = None
+        self.mono_family = None
+        self.font_sets = {}
+        self.ui_fonts = {}
+        self.welcome_segments = None
+        self.documents = DocumentCache(self.DOCUMENT_CACHE_BYTES)
+        self.recent = self._read_recent()
+        self.themes = self._read_themes()
+        self.theme_name = self._read_theme_name()
+        self.theme = self.themes[self.theme_name]
+        self.scanner = None
+        self.search_indexes = {}
+        self.image_reader = None
+        self.images = _ImageCache(self.IMAGE_CACHE_BYTES)
+        self.highlighter = None
+        self.highlights = _LRU(self.HIGHLIGHT_CACHE_ENTRIES)
+
+        self.prefetcher = None
+        if prefetch_share > 0:
+            self.prefetcher = Prefetcher(root, self.documents, self.parser,
+                                         min(prefetch_share, 1.0))
+            self.prefetcher.start()
+            # Recent files wait until the first window has been drawn
+            self.prefetcher.hold()
+            self.prefetcher.request(self.recent)
+
+    def load(self, path):
+        """Return the parsed document for path, re-reading it only if it
+        is not cached or has changed on disk."""
+        self.hold_prefetch()
+        document = self.documents.get(path)
+        if document is None:
+            document = load_document(path, self.parser)
+            self.documents.put(document)
+        return document
+
+    def read_image(self, path, callback):
+        """Read path on the image thread, starting it on first use."""
+        if self.image_reader is None:
+            self.image_reader = ImageReader(self.root)
+            self.image_reader.start()
+        self.image_reader.submit(path, callback)
+
+    def highlight(self, request, callback):
+        """Highlight a code block on the highlighter thread, starting it
+        on first use, and remember the result by the request's key."""
+        if self.highlighter is None:
+            self.highlighter = CodeHighlighter(self.root)
+            self.highlighter.start()
+        self.highlighter.submit(request,
+                                lambda request, ranges:
+                                self._highlighted(request, ranges, callback))
+
+    def _highlighted(self, request, ranges, callback):
+        self.highlights.put(request[0], ranges)
+        callback(request, ranges)
+
+    def search_index(self, folder):
+        """Return the (possibly not yet loaded) search index of folder."""
+        index = self.search_indexes.get(folder)
+        if index is None:
+            index = FolderIndex(folder, _index_path(folder))
+            self.search_indexes[folder] = index
+        return index
+
+    def directory_scanner(self):
+        """Return the folder scanner shared by all windows, starting it
+        on first use."""
+        if self.scanner is None:
+            self.scanner = DirectoryScanner(self.root)
+            self.scanner.start()
+        return self.scanner
+
+    def hold_prefetch(self):
+        """Pause background prefetching while foreground work runs."""
+        if self.prefetcher is not None:
+            self.prefetcher.hold()
+
+    def prefetch(self, paths):
+        if self.prefetcher is not None and paths:
+            self.prefetcher.request(paths)
+
+    def _read_recent(self):
+        config = _read_config(self.RECENT_FILES)
+        recent = []
+        for i in xrange(self.MAX_RECENT):
+            try:
+                recent.append(config.get('recent', 'file%d' % i))
+            except ConfigParser.Error:
+                break
+        return recent
+
+    def _read_themes(self):
+        """Return {name: {role: colour}} for the bundled themes and the
+        user's, each filled out from DEFAULT_THEME.
+
+        The user's file is laid over the bundled one, so it only needs the
+        colours it changes.
+        """
+        themes = {self.DEFAULT_THEME_NAME: dict(self.DEFAULT_THEME)}
+        for directory in (APP_DIR, CONFIG_DIR):
+            config = ConfigParser.RawConfigParser()
+            try:
+                config.read([os.path.join(directory, self.THEME_FILE)])
+            except ConfigParser.Error:
+                continue
+            for name in config.sections():
+                theme = themes.setdefault(name, dict(self.DEFAULT_THEME))
+                for role, color in config.items(name):
+                    if role not in theme:
+                        continue
+                    try:
+                        self.root.winfo_rgb(color)
+                    except tk.TclError:
+                        # Not a colour Tk knows; keep the one we have
+                        continue
+                    theme[role] = color
+        return themes
+
+    def _read_theme_name(self):
+        try:
+            name = _read_config(self.SETTINGS).get('view', 'theme')
+        except ConfigParser.Error:
+            return self.DEFAULT_THEME_NAME
+        if name not in self.themes:
+            return self.DEFAULT_THEME_NAME
+        return name
+
+    def set_theme(self, name):
+        """Recolour every window with the theme called name and remember
+        the choice for the next launch."""
+        if name not in self.themes or name == self.theme_name:
+            return
+        self.theme_name = name
+        self.theme = self.themes[name]
+        config = _read_config(self.SETTINGS)
+        if not config.has_section('view'):
+            config.add_section('view')
+        config.set('view', 'theme', name)
+        _write_config(self.SETTINGS, config)
+        for window in self.windows:
+            window.apply_theme()
+
+    def add_recent(self, path):
+        """Move path to the front of the recent files and save the list."""
+        path = os.path.abspath(path)
+        if self.recent and self.recent[0] == path:
+            return
+        if path in self.recent:
+            self.recent.remove(path)
+        self.recent.insert(0, path)
+        del self.recent[self.MAX_RECENT:]
+        config = ConfigParser.RawConfigParser()
+        config.add_section('recent')
+        for i, recent_path in enumerate(self.recent):
+            config.set('recent', 'file%d' % i, recent_path)
+        _write_config(self.RECENT_FILES, config)
+
+    def resolve_families(self):
+        """Pick the proportional and monospace families.
+
+        tkFont.families() enumerates every installed font, which is slow
+        on X11 and on older Macs, so the choice is cached in the config
+        directory and reused for as long as the windowing system matches.
+        """
+        system = self.root.tk.call('tk', 'windowingsystem')
+        cache = _read_config(self.FONT_CACHE)
+        try:
+            if cache.get('fonts', 'windowing_system') == system:
+                return (cache.get('fonts', 'family'),
+                        cache.get('fonts', 'mono_family'))
+        except ConfigParser.Error:
+            pass
 
-    def _setup_fonts(self):
         available = list(tkFont.families())
 
         if "Lucida Grande" in available:
@@ -70,32 +1332,280 @@ class MarkdownViewer(object):
         else:
             mono_family = "TkFixedFont"
 
-        base_size = 13
-
-        self.fonts = {
-            'normal': tkFont.Font(family=family, size=base_size),
-            'bold': tkFont.Font(family=family, size=base_size, weight="bold"),
-            'italic': tkFont.Font(family=family, size=base_size, slant="italic"),
-            'bold_italic': tkFont.Font(family=family, size=base_size,
-                                       weight="bold", slant="italic"),
-            'h1': tkFont.Font(family=family, size=base_size + 13, weight="bold"),
-            'h2': tkFont.Font(family=family, size=base_size + 9, weight="bold"),
-            'h3': tkFont.Font(family=family, size=base_size + 5, weight="bold"),
-            'h4': tkFont.Font(family=family, size=base_size + 3, weight="bold"),
-            'h5': tkFont.Font(family=family, size=base_size + 1, weight="bold"),
-            'h6': tkFont.Font(family=family, size=base_size, weight="bold"),
-            'code': tkFont.Font(family=mono_family, size=base_size - 1),
-            'code_block': tkFont.Font(family=mono_family, size=base_size - 1),
-        }
-
-        self.base_size = base_size
+        cache = ConfigParser.RawConfigParser()
+        cache.add_section('fonts')
+        cache.set('fonts', 'windowing_system', system)
+        cache.set('fonts', 'family', family)
+        cache.set('fonts', 'mono_family', mono_family)
+        _write_config(self.FONT_CACHE, cache)
+        return family, mono_family
+
+    def font_set(self, zoom):
+        """Return the fonts for a zoom level.
+
+        Zooming swaps tags over to another cached set instead of
+        reconfiguring fonts in place, so the text widget reflows once per
+        zoom step rather than once per font.
+        """
+        fonts = self.font_sets.get(zoom)
+        if fonts is None:
+            if self.family is None:
+                self.family, self.mono_family = self.resolve_families()
+
+            def size_for(offset):
+                return max(self.MIN_FONT_SIZE,
+                           self.BASE_FONT_SIZE + offset + zoom)
+            fonts = _FontSet(self.FONT_SPECS, self.family, self.mono_family,
+                             size_for)
+            self.font_sets[zoom] = fonts
+        return fonts
+
+    def ui_font(self, size):
+        """Return the shared chrome font (toolbar, find bar, status bar)."""
+        font = self.ui_fonts.get(size)
+        if font is None:
+            font = self.ui_fonts[size] = tkFont.Font(size=size)
+        return font
+
+    def new_window(self, filepaths=()):
+        """Open another viewer window as a Toplevel of the shared root."""
+        return MarkdownViewer(tk.Toplevel(self.root), filepaths, session=self)
+
+    def open_files(self, paths):
+        """Open paths in the most recently created window."""
+        if self.windows:
+            self.windows[-1].open_files_from_instance(paths)
+
+    def close_window(self, viewer):
+        """Forget a closed window, ending the app after the last one.
+
+        The Tk root can't be destroyed without destroying every window,
+        so when its viewer closes first it is only hidden.
+        """
+        self.windows.remove(viewer)
+        if not self.windows:
+            self.root.destroy()
+        elif viewer.root is self.root:
+            self.root.withdraw()
+        else:
+            viewer.root.destroy()
+
+
+class MarkdownViewer(object):
+    """Main application window for the Markdown Viewer."""
+
+    APP_NAME = "Markdown Viewer"
+    WINDOW_WIDTH = 720
+    WINDOW_HEIGHT = 580
+
+    ZOOM_STEP = 2
+
+    # (tag, font name) for every tag that sets a font
+    TAG_FONTS = (
+        ('h1', 'h1'), ('h2', 'h2'), ('h3', 'h3'),
+        ('h4', 'h4'), ('h5', 'h5'), ('h6', 'h6'),
+        ('normal', 'normal'), ('bold', 'bold'), ('italic', 'italic'),
+        ('bold_italic', 'bold_italic'), ('code_inline', 'code'),
+        ('code_block', 'code_block'), ('list_bullet', 'normal'),
+        ('list_item', 'normal'), ('blockquote', 'italic'),
+        ('blockquote_bar', 'normal'), ('link_text', 'normal'),
+        ('link_url', 'code'), ('image_icon', 'bold'),
+        ('table_header', 'code_bold'), ('table', 'code'),
+        ('footnote_ref', 'normal'),
+    )
+
+    # Tags the code highlighter's tokens are shown with
+    CODE_TOKEN_TAGS = ('code_keyword', 'code_string', 'code_comment',
+                       'code_number', 'code_variable')
+
+    # (tag, option, theme colour) for every tag coloured by the theme
+    TAG_COLORS = (
+        ('h1', 'foreground', 'text'), ('h2', 'foreground', 'text'),
+        ('h3', 'foreground', 'text'), ('h4', 'foreground', 'text'),
+        ('h5', 'foreground', 'text'), ('h6', 'foreground', 'h6'),
+        ('code_inline', 'background', 'code_background'),
+        ('code_inline', 'foreground', 'code_inline'),
+        ('code_block', 'background', 'code_background'),
+        ('code_block', 'foreground', 'text'),
+        ('list_bullet', 'foreground', 'accent'),
+        ('blockquote', 'foreground', 'blockquote'),
+        ('blockquote_bar', 'foreground', 'accent'),
+        ('hr', 'foreground', 'hr'),
+        ('link_text', 'foreground', 'accent'),
+        ('link_url', 'foreground', 'link_url'),
+        ('image_icon', 'foreground', 'image_icon'),
+        ('footnote_ref', 'foreground', 'accent'),
+        ('fold_marker', 'foreground', 'accent'),
+        ('find_highlight', 'background', 'find_highlight'),
+        ('find_highlight', 'foreground', 'find_text'),
+        ('find_current', 'background', 'find_current'),
+        ('find_current', 'foreground', 'find_text'),
+        ('code_keyword', 'foreground', 'code_keyword'),
+        ('code_string', 'foreground', 'code_string'),
+        ('code_comment', 'foreground', 'code_comment'),
+        ('code_number', 'foreground', 'code_number'),
+        ('code_variable', 'foreground', 'code_variable'),
+    )
+
+    # Bytes of document text kept rendered in inactive tabs' widgets
+    TAB_MEMORY_BUDGET = 4 * 1024 * 1024
+
+    MAX_HISTORY = 50
+
+    # Formats tk.PhotoImage can decode; PNG arrived in Tk 8.6
+    IMAGE_EXTENSIONS = ('.gif', '.ppm', '.pgm')
+    if tk.TkVersion >= 8.6:
+        IMAGE_EXTENSIONS += ('.png',)
+    PREFETCH_LINKS = 16
+
+    # Lines scrolled per unit of wheel delta, by windowing system.  Aqua
+    # reports lines already (accelerated by the system); Windows and X11
+    # report WHEEL_NOTCH per notch, which scrolls three lines.
+    WHEEL_NOTCH = 120
+    WHEEL_LINES = {'aqua': 1.0, 'win32': 3.0 / WHEEL_NOTCH,
+                   'x11': 3.0 / WHEEL_NOTCH}
+    # Event state bits of the modifiers that leave the wheel to the Text
+    # class bindings (Option-wheel scrolls faster on Aqua): Control, with
+    # Command and Option on Aqua, and Alt elsewhere.  Shift scrolls
+    # sideways here; Caps Lock and Num Lock don't count.
+    WHEEL_MODIFIERS = {'aqua': 0x4 | 0x8 | 0x10, 'win32': 0x4 | 0x20000,
+                       'x11': 0x4 | 0x8}
+
+    HEADING_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+    FOLD_OPEN_MARKER = u'\u25be '
+    FOLD_CLOSED_MARKER = u'\u25b8 '
+    INSERT_BATCH = 500
+
+    WELCOME_TEXT = (
+        "# Welcome to Markdown Viewer\n\n"
+        "This is a lightweight Markdown viewer for **PowerPC Macs**.\n\n"
+        "## Getting Started\n\n"
+        "- Use **File > Open** (or **Cmd+O**) to open a `.md` file\n"
+        "- Use **Cmd+R** to reload the current file\n"
+        "- Use **Cmd+** / **Cmd-** to zoom in and out\n"
+        "- Use **Cmd+F** to search within the document\n\n"
+        "## Supported Markdown\n\n"
+        "- **Bold**, *italic*, and ***bold italic***\n"
+        "- Nested formatting like ***bold and italic*** inside *an italic phrase*\n"
+        "- `Inline code` and fenced code blocks\n"
+        "- Headings (H1 through H6)\n"
+        "- Ordered and unordered lists\n"
+        "- Blockquotes\n"
+        "- Horizontal rules\n"
+        "- ~~Strikethrough~~\n"
+        "- [Links](https://example.com) with visible URLs\n"
+        "- ![Image references](path/to/image.png) displayed as paths\n\n"
+        "---\n\n"
+        "*Built for Mac OS X Leopard on PowerPC*\n"
+    )
+
+    def __init__(self, root, filepaths=(), profile_startup=False,
+                 session=None, preload=None):
+        self.root = root
+        if session is None:
+            session = ViewerSession(root)
+        self.session = session
+        self.parser = session.parser
+        session.windows.append(self)
+        self.tabs = []
+        self.tab = None
+        self.text = None
+        self._tab_clock = 0
+        self.fold_on_open = tk.BooleanVar()
+        self.fold_on_open.set(False)
+        self.show_sidebar = tk.BooleanVar()
+        self.show_sidebar.set(False)
+        self.split_view = tk.BooleanVar()
+        self.split_view.set(False)
+        self.theme_name = tk.StringVar()
+        self.theme_name.set(session.theme_name)
+        self.profile_startup = profile_startup
+
+        for setup in (self._setup_window, self._setup_fonts,
+                      self._setup_menu, self._setup_ui, self._bind_keys):
+            self._timed(setup.__name__, setup)
+
+        self._timed('first render', self._open_initial, filepaths, preload)
+
+        if profile_startup:
+            self._timed('first paint', self.root.update_idletasks)
+            sys.stderr.write("%-16s %8.1f ms\n" % (
+                'since launch', (time.time() - _LAUNCH_TIME) * 1000.0))
+
+    def _open_initial(self, filepaths, preload):
+        """Open the launch files as tabs, rendering only the first.
+
+        The remaining tabs are read and parsed when first shown.  preload,
+        if given, is a PreloadThread already working on the first file.
+        """
+        first = None
+        for filepath in filepaths:
+            if os.path.isdir(filepath) or is_archive(filepath):
+                self.show_folder(filepath)
+                continue
+            if not is_file(filepath):
+                continue
+            tab_preload = None
+            if preload is not None and preload.filepath == filepath:
+                tab_preload = preload
+            tab = self._new_tab(filepath, preload=tab_preload)
+            if first is None:
+                first = tab
+        if first is not None:
+            self._select_tab(first)
+        if self.tab is None:
+            self._select_nearest_tab(0)
+
+    def _timed(self, label, func, *args):
+        """Call func, reporting how long it took if profiling startup."""
+        if not self.profile_startup:
+            return func(*args)
+        started = time.time()
+        try:
+            return func(*args)
+        finally:
+            sys.stderr.write("%-16s %8.1f ms\n" % (
+                label, (time.time() - started) * 1000.0))
+
+    def _setup_window(self):
+        self.root.title(self.APP_NAME)
+        self.root.geometry("%dx%d" % (self.WINDOW_WIDTH, self.WINDOW_HEIGHT))
+        self.root.minsize(400, 300)
+        self.root.configure(bg=self.session.theme['background'])
+
+    def _setup_fonts(self):
+        self.zoom = 0
+        self.fonts = self.session.font_set(self.zoom)
+
+    def _ui_font(self, size):
+        return self.session.ui_font(size)
+
+    def _apply_fonts(self, fonts):
+        """Point every font-bearing tag in use at the given font set.
+
+        Tags that have not appeared in the document yet keep no font;
+        _insert_segments() gives them one the first time they are used.
+        """
+        t = self.text
+        for tag, name in self.TAG_FONTS:
+            if tag not in self.tab.pending_font_tags:
+                t.tag_configure(tag, font=fonts[name])
+        t.configure(font=fonts['normal'])
+        if self.peer is not None:
+            self.peer.configure(font=fonts['normal'])
+        self.tab.font_zoom = self.zoom
 
     def _setup_menu(self):
         menubar = tk.Menu(self.root)
 
         file_menu = tk.Menu(menubar, tearoff=0)
+        file_menu.add_command(label="New Window", command=self.cmd_new_window,
+                              accelerator="Command-N")
         file_menu.add_command(label="Open...", command=self.cmd_open,
                               accelerator="Command-O")
+        file_menu.add_command(label="Open Folder...",
+                              command=self.cmd_open_folder,
+                              accelerator="Command-Shift-O")
         file_menu.add_command(label="Reload", command=self.cmd_reload,
                               accelerator="Command-R")
         file_menu.add_separator()
@@ -111,8 +1621,24 @@ class MarkdownViewer(object):
         edit_menu.add_separator()
         edit_menu.add_command(label="Find...", command=self.cmd_find,
                               accelerator="Command-F")
+        edit_menu.add_command(label="Search Folder...",
+                              command=self.cmd_search_folder,
+                              accelerator="Command-Shift-F")
         menubar.add_cascade(label="Edit", menu=edit_menu)
 
+        go_menu = tk.Menu(menubar, tearoff=0)
+        go_menu.add_command(label="Back", command=self.cmd_back,
+                            accelerator="Command-[")
+        go_menu.add_command(label="Forward", command=self.cmd_forward,
+                            accelerator="Command-]")
+        go_menu.add_separator()
+        go_menu.add_command(label="Next Page", command=self.cmd_next_page,
+                            accelerator="Command-PgDn")
+        go_menu.add_command(label="Previous Page",
+                            command=self.cmd_prev_page,
+                            accelerator="Command-PgUp")
+        menubar.add_cascade(label="Go", menu=go_menu)
+
         view_menu = tk.Menu(menubar, tearoff=0)
         view_menu.add_command(label="Zoom In", command=self.cmd_zoom_in,
                               accelerator="Command-+")
@@ -120,156 +1646,239 @@ class MarkdownViewer(object):
                               accelerator="Command--")
         view_menu.add_command(label="Reset Zoom", command=self.cmd_zoom_reset,
                               accelerator="Command-0")
+        view_menu.add_separator()
+        view_menu.add_command(label="Collapse All Sections",
+                              command=self.cmd_collapse_all)
+        view_menu.add_command(label="Expand All Sections",
+                              command=self.cmd_expand_all)
+        view_menu.add_checkbutton(label="Collapse Sections on Open",
+                                  variable=self.fold_on_open)
+        view_menu.add_checkbutton(label="Split View",
+                                  variable=self.split_view,
+                                  command=self.cmd_toggle_split)
+        view_menu.add_checkbutton(label="Folder Sidebar",
+                                  variable=self.show_sidebar,
+                                  command=self.cmd_toggle_sidebar)
+        theme_menu = tk.Menu(view_menu, tearoff=0)
+        names = self.session.themes.keys()
+        names.sort()
+        for name in names:
+            theme_menu.add_radiobutton(label=name.replace('-', ' ').title(),
+                                       variable=self.theme_name, value=name,
+                                       command=self.cmd_theme)
+        view_menu.add_cascade(label="Theme", menu=theme_menu)
+        view_menu.add_separator()
+        view_menu.add_command(label="Next Tab", command=self.cmd_next_tab,
+                              accelerator="Command-}")
+        view_menu.add_command(label="Previous Tab",
+                              command=self.cmd_prev_tab,
+                              accelerator="Command-{")
         menubar.add_cascade(label="View", menu=view_menu)
 
         self.root.config(menu=menubar)
 
     def _setup_ui(self):
+        theme = self.session.theme
+
         # Top toolbar with file info
-        self.toolbar = tk.Frame(self.root, bg="#E8E8E8", height=28)
+        self.toolbar = tk.Frame(self.root, bg=theme['toolbar'], height=28)
         self.toolbar.pack(fill=tk.X, side=tk.TOP)
         self.toolbar.pack_propagate(False)
 
         self.file_label = tk.Label(
             self.toolbar, text="No file loaded",
-            bg="#E8E8E8", fg="#666666",
-            font=tkFont.Font(size=11), anchor=tk.W, padx=10
+            bg=theme['toolbar'], fg=theme['toolbar_text'],
+            font=self._ui_font(11), anchor=tk.W, padx=10
         )
         self.file_label.pack(fill=tk.X, expand=True)
 
-        # Main text area with scrollbar
-        text_frame = tk.Frame(self.root)
-        text_frame.pack(fill=tk.BOTH, expand=True)
+        # Tab bar, shown while more than one document is open
+        self.tabbar = tk.Frame(self.root, bg=theme['tabbar'], height=24)
+        self.tabbar.pack_propagate(False)
+        self.tabbar_visible = False
 
-        self.scrollbar = tk.Scrollbar(text_frame)
-        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        # Document panes: the main text area with scrollbar (each live
+        # tab adds a Text here), and an optional split view below it
+        self.panes = tk.PanedWindow(self.root, orient=tk.VERTICAL,
+                                    sashwidth=5, borderwidth=0,
+                                    bg=theme['toolbar'])
+        self.panes.pack(fill=tk.BOTH, expand=True)
 
-        self.text = tk.Text(
-            text_frame, wrap=tk.WORD,
-            bg=self.BG_COLOR, fg=self.TEXT_COLOR,
-            font=self.fonts['normal'],
-            padx=30, pady=20,
-            spacing1=2, spacing3=2,
-            cursor="arrow",
-            state=tk.DISABLED,
-            relief=tk.FLAT,
-            highlightthickness=0,
-            yscrollcommand=self.scrollbar.set
-        )
-        self.text.pack(fill=tk.BOTH, expand=True)
-        self.scrollbar.config(command=self.text.yview)
-
-        # Find bar (hidden by default)
-        self.find_frame = tk.Frame(self.root, bg="#E8E8D8", height=30)
-        self.find_frame.pack_propagate(False)
-        self.find_visible = False
-
-        find_label = tk.Label(self.find_frame, text="Find:",
-                              bg="#E8E8D8", fg="#333333",
-                              font=tkFont.Font(size=11))
-        find_label.pack(side=tk.LEFT, padx=(10, 4))
+        self.text_frame = tk.Frame(self.panes, bg=theme['background'])
+        self.panes.add(self.text_frame)
 
-        self.find_entry = tk.Entry(self.find_frame, width=30,
-                                    font=tkFont.Font(size=11),
-                                    highlightthickness=1,
-                                    relief=tk.SOLID)
-        self.find_entry.pack(side=tk.LEFT, padx=2, pady=4)
-        self.find_entry.bind('<Return>', lambda e: self._do_find())
-        self.find_entry.bind('<Escape>', lambda e: self._hide_find_bar())
-
-        find_btn = tk.Button(self.find_frame, text="Next",
-                             command=self._do_find,
-                             font=tkFont.Font(size=10))
-        find_btn.pack(side=tk.LEFT, padx=4)
-
-        find_prev_btn = tk.Button(self.find_frame, text="Prev",
-                                   command=self._do_find_prev,
-                                   font=tkFont.Font(size=10))
-        find_prev_btn.pack(side=tk.LEFT, padx=2)
-
-        self.find_count_label = tk.Label(self.find_frame, text="",
-                                          bg="#E8E8D8", fg="#666666",
-                                          font=tkFont.Font(size=10))
-        self.find_count_label.pack(side=tk.LEFT, padx=8)
-
-        find_close_btn = tk.Button(self.find_frame, text="\xC3\x97",
-                                    command=self._hide_find_bar,
-                                    font=tkFont.Font(size=11),
-                                    relief=tk.FLAT, bg="#E8E8D8")
-        find_close_btn.pack(side=tk.RIGHT, padx=6)
+        self.scrollbar = tk.Scrollbar(self.text_frame)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
+        self.split_frame = None
+        self.peer = None
+        self.over_link = False
+
+        # Wheel movement not yet scrolled, in lines, by widget and axis
+        system = self.root.tk.call('tk', 'windowingsystem')
+        self.wheel_lines = self.WHEEL_LINES.get(system,
+                                                self.WHEEL_LINES['x11'])
+        self.wheel_modifiers = self.WHEEL_MODIFIERS.get(
+            system, self.WHEEL_MODIFIERS['x11'])
+        self.wheel_pending = {}
+        self.wheel_after = None
+
+        # Inline images: slots waiting for a file read, by path
+        self.image_waiting = {}
+        self.image_check_pending = False
+        # Counter for the tags that track pending images and code blocks
+        self._slot_tags = 0
+
+        # Code blocks waiting for the highlighter, by content hash
+        self.highlight_waiting = {}
+        self.highlight_pending = False
+
+        # Folder sidebar (built when a folder is first opened)
+        self.browser = None
+        self.search_dialog = None
+
+        # Find bar (hidden by default, built on first use)
+        self.find_frame = None
+        self.find_visible = False
         self.find_pos = '1.0'
 
         # Status bar
-        self.statusbar = tk.Frame(self.root, bg="#E0E0E0", height=22)
+        self.statusbar = tk.Frame(self.root, bg=theme['statusbar'], height=22)
         self.statusbar.pack(fill=tk.X, side=tk.BOTTOM)
         self.statusbar.pack_propagate(False)
 
         self.status_label = tk.Label(
             self.statusbar, text="Ready",
-            bg="#E0E0E0", fg="#888888",
-            font=tkFont.Font(size=10), anchor=tk.W, padx=10
+            bg=theme['statusbar'], fg=theme['status_text'],
+            font=self._ui_font(10), anchor=tk.W, padx=10
         )
         self.status_label.pack(fill=tk.X, expand=True)
 
-    def _setup_tags(self):
-        """Configure text widget tags for markdown styling."""
-        t = self.text
+    def _text_options(self):
+        """Widget options shared by document Text widgets and their peers."""
+        return dict(
+            wrap=tk.WORD,
+            bg=self.session.theme['background'],
+            fg=self.session.theme['text'],
+            font=self.fonts['normal'],
+            padx=30, pady=20,
+            spacing1=2, spacing3=2,
+            cursor="arrow",
+            state=tk.DISABLED,
+            relief=tk.FLAT,
+            highlightthickness=0
+        )
 
-        t.tag_configure('h1', font=self.fonts['h1'], foreground=self.TEXT_COLOR,
-                         spacing1=16, spacing3=8)
-        t.tag_configure('h2', font=self.fonts['h2'], foreground=self.TEXT_COLOR,
-                         spacing1=14, spacing3=6)
-        t.tag_configure('h3', font=self.fonts['h3'], foreground=self.TEXT_COLOR,
-                         spacing1=10, spacing3=4)
-        t.tag_configure('h4', font=self.fonts['h4'], foreground=self.TEXT_COLOR,
-                         spacing1=8, spacing3=4)
-        t.tag_configure('h5', font=self.fonts['h5'], foreground=self.TEXT_COLOR,
-                         spacing1=6, spacing3=2)
-        t.tag_configure('h6', font=self.fonts['h6'], foreground="#444444",
-                         spacing1=6, spacing3=2)
-
-        t.tag_configure('normal', font=self.fonts['normal'])
-        t.tag_configure('bold', font=self.fonts['bold'])
-        t.tag_configure('italic', font=self.fonts['italic'])
-        t.tag_configure('bold_italic', font=self.fonts['bold_italic'])
-        t.tag_configure('code_inline', font=self.fonts['code'],
-                         background=self.CODE_BG, foreground="#C7254E")
+    def _create_text(self):
+        """Create a document Text widget with its tags and bindings."""
+        t = tk.Text(self.text_frame, **self._text_options())
+        self._setup_tags(t)
+        self._bind_text(t)
+        return t
+
+    def _bind_text(self, t):
+        """Bind the per-widget events of a document or split-view pane.
+
+        Links are hit-tested against the tab's link index rather than
+        through a tag binding, so there is one binding however many links
+        the page has.
+        """
+        t.bind('<MouseWheel>', self._on_mousewheel)
+        t.bind('<Shift-MouseWheel>',
+               lambda e: self._on_mousewheel(e, 'x'))
+        # X11 reports the wheel as buttons 4 and 5
+        for button in ('<Button-4>', '<Button-5>'):
+            t.bind(button, self._on_wheel_button)
+            t.bind('<Shift-%s' % button[1:],
+                   lambda e: self._on_wheel_button(e, 'x'))
+        t.bind('<Button-1>', self._on_text_click)
+        t.bind('<Motion>', self._on_text_motion)
+
+    def _setup_tags(self, t):
+        """Configure text widget tags for markdown styling.
+
+        Tags are created in priority order; their fonts come from
+        _apply_fonts() so that zooming can swap them in one pass, and
+        their colours from _color_tags() so that themes can.
+        """
+
+        t.tag_configure('h1', spacing1=16, spacing3=8)
+        t.tag_configure('h2', spacing1=14, spacing3=6)
+        t.tag_configure('h3', spacing1=10, spacing3=4)
+        t.tag_configure('h4', spacing1=8, spacing3=4)
+        t.tag_configure('h5', spacing1=6, spacing3=2)
+        t.tag_configure('h6', spacing1=6, spacing3=2)
+
+        t.tag_configure('normal')
+        t.tag_configure('bold')
+        t.tag_configure('italic')
+        t.tag_configure('bold_italic')
+        t.tag_configure('code_inline')
         t.tag_configure('strikethrough', overstrike=True)
 
-        t.tag_configure('code_block', font=self.fonts['code_block'],
-                         background=self.CODE_BG, foreground=self.TEXT_COLOR,
-                         lmargin1=30, lmargin2=30, rmargin=30,
+        t.tag_configure('code_block', lmargin1=30, lmargin2=30, rmargin=30,
                          spacing1=6, spacing3=6)
 
-        t.tag_configure('list_bullet', font=self.fonts['normal'],
-                         foreground=self.ACCENT_COLOR)
-        t.tag_configure('list_item', font=self.fonts['normal'])
+        t.tag_configure('list_bullet')
+        t.tag_configure('list_item')
+
+        t.tag_configure('blockquote', lmargin1=40, lmargin2=40)
+        t.tag_configure('blockquote_bar')
+
+        t.tag_configure('hr', justify=tk.CENTER, spacing1=8, spacing3=8)
+
+        t.tag_configure('link_text', underline=True)
+        t.tag_configure('link_url')
+        t.tag_configure('image_icon')
+        t.tag_configure('footnote_ref', offset=4)
+
+        # Tables come laid out by the parser; wrapping would break the
+        # columns, so long rows run off the right edge instead.  They are
+        # above the link tags so that links in cells keep the monospace
+        # font, and set no colour so that those links keep theirs.
+        t.tag_configure('table_header', lmargin1=30, lmargin2=30,
+                         wrap=tk.NONE, spacing1=6)
+        t.tag_configure('table', lmargin1=30, lmargin2=30, wrap=tk.NONE,
+                         spacing3=6)
+
+        t.tag_configure('fold_marker')
+        for tag in self.HEADING_TAGS:
+            t.tag_bind(tag, '<Button-1>', self._on_heading_click)
+            t.tag_bind(tag, '<Enter>',
+                       lambda e: e.widget.config(cursor="hand2"))
+            t.tag_bind(tag, '<Leave>',
+                       lambda e: e.widget.config(cursor="arrow"))
+
+        t.tag_configure('find_highlight')
+        t.tag_configure('find_current')
 
-        t.tag_configure('blockquote', font=self.fonts['italic'],
-                         foreground=self.BLOCKQUOTE_COLOR,
-                         lmargin1=40, lmargin2=40)
-        t.tag_configure('blockquote_bar', foreground=self.ACCENT_COLOR,
-                         font=self.fonts['normal'])
+        # The text stand-in for an image, hidden once the image is shown
+        t.tag_configure('image_placeholder', elide=True)
 
-        t.tag_configure('hr', foreground=self.HR_COLOR, justify=tk.CENTER,
-                         spacing1=8, spacing3=8)
+        for tag in self.CODE_TOKEN_TAGS:
+            t.tag_configure(tag)
 
-        t.tag_configure('link_text', font=self.fonts['normal'],
-                         foreground=self.ACCENT_COLOR, underline=True)
-        t.tag_configure('link_url', font=self.fonts['code'],
-                         foreground="#888888")
-        t.tag_configure('image_icon', font=self.fonts['bold'],
-                         foreground="#D4882A")
+        self._color_tags(t)
 
-        t.tag_configure('find_highlight', background="#FFFF00",
-                         foreground="#000000")
-        t.tag_configure('find_current', background="#FF9632",
-                         foreground="#000000")
+    def _color_tags(self, t):
+        """Give t's tags the colours of the session's theme."""
+        theme = self.session.theme
+        options = {}
+        for tag, option, color in self.TAG_COLORS:
+            options.setdefault(tag, {})[option] = theme[color]
+        for tag, tag_options in options.iteritems():
+            t.tag_configure(tag, **tag_options)
 
     def _bind_keys(self):
+        self.root.protocol('WM_DELETE_WINDOW', self.cmd_close_window)
+        self.root.bind('<Command-n>', lambda e: self.cmd_new_window())
+        self.root.bind('<Command-N>', lambda e: self.cmd_new_window())
         self.root.bind('<Command-o>', lambda e: self.cmd_open())
+        # Caps Lock gives the upper case keysym without Shift; the Shift
+        # bindings are the more specific and win when it is held
         self.root.bind('<Command-O>', lambda e: self.cmd_open())
+        self.root.bind('<Command-Shift-o>', lambda e: self.cmd_open_folder())
+        self.root.bind('<Command-Shift-O>', lambda e: self.cmd_open_folder())
         self.root.bind('<Command-r>', lambda e: self.cmd_reload())
         self.root.bind('<Command-R>', lambda e: self.cmd_reload())
         self.root.bind('<Command-w>', lambda e: self.cmd_close())
@@ -282,49 +1891,466 @@ class MarkdownViewer(object):
         self.root.bind('<Command-A>', lambda e: self.cmd_select_all())
         self.root.bind('<Command-f>', lambda e: self.cmd_find())
         self.root.bind('<Command-F>', lambda e: self.cmd_find())
+        self.root.bind('<Command-Shift-f>',
+                       lambda e: self.cmd_search_folder())
+        self.root.bind('<Command-Shift-F>',
+                       lambda e: self.cmd_search_folder())
         self.root.bind('<Escape>', lambda e: self._hide_find_bar())
-        self.text.bind('<MouseWheel>', self._on_mousewheel)
-
-    def _on_mousewheel(self, event):
-        self.text.yview_scroll(-1 * (event.delta), "units")
+        self.root.bind('<Command-bracketleft>', lambda e: self.cmd_back())
+        self.root.bind('<Command-bracketright>', lambda e: self.cmd_forward())
+        self.root.bind('<Command-Next>', lambda e: self.cmd_next_page())
+        self.root.bind('<Command-Prior>', lambda e: self.cmd_prev_page())
+        self.root.bind('<Command-braceright>', lambda e: self.cmd_next_tab())
+        self.root.bind('<Command-braceleft>', lambda e: self.cmd_prev_tab())
+
+    def _on_mousewheel(self, event, axis='y'):
+        if event.state & self.wheel_modifiers:
+            return None
+        self._queue_scroll(event.widget, axis, event.delta)
+        return 'break'
+
+    def _on_wheel_button(self, event, axis='y'):
+        if event.state & self.wheel_modifiers:
+            return None
+        if event.num == 4:
+            self._queue_scroll(event.widget, axis, self.WHEEL_NOTCH)
+        else:
+            self._queue_scroll(event.widget, axis, -self.WHEEL_NOTCH)
+        return 'break'
+
+    def _queue_scroll(self, widget, axis, delta):
+        """Add a wheel movement to widget's pending scroll along axis,
+        'x' or 'y'.
+
+        Trackpads send wheel events in bursts, and scrolling for each one
+        would redraw the text once per event; instead the burst is summed
+        and scrolled once, when Tk is next idle.
+        """
+        key = (widget, axis)
+        self.wheel_pending[key] = (self.wheel_pending.get(key, 0.0) -
+                                   delta * self.wheel_lines)
+        if self.wheel_after is None:
+            self.wheel_after = self.root.after_idle(self._flush_scroll)
+
+    def _flush_scroll(self):
+        self.wheel_after = None
+        pending = self.wheel_pending
+        self.wheel_pending = {}
+        for (widget, axis), lines in pending.iteritems():
+            if not widget.winfo_exists():
+                continue
+            whole = int(lines)
+            if whole:
+                if axis == 'x':
+                    widget.xview_scroll(whole, 'units')
+                else:
+                    widget.yview_scroll(whole, 'units')
+            if lines != whole:
+                # Keep the fraction of a line for the next movement
+                self.wheel_pending[(widget, axis)] = lines - whole
 
     def _show_welcome(self):
-        welcome = (
-            "# Welcome to Markdown Viewer\n\n"
-            "This is a lightweight Markdown viewer for **PowerPC Macs**.\n\n"
-            "## Getting Started\n\n"
-            "- Use **File > Open** (or **Cmd+O**) to open a `.md` file\n"
-            "- Use **Cmd+R** to reload the current file\n"
-            "- Use **Cmd+** / **Cmd-** to zoom in and out\n"
-            "- Use **Cmd+F** to search within the document\n\n"
-            "## Supported Markdown\n\n"
-            "- **Bold**, *italic*, and ***bold italic***\n"
-            "- Nested formatting like ***bold and italic*** inside *an italic phrase*\n"
-            "- `Inline code` and fenced code blocks\n"
-            "- Headings (H1 through H6)\n"
-            "- Ordered and unordered lists\n"
-            "- Blockquotes\n"
-            "- Horizontal rules\n"
-            "- ~~Strikethrough~~\n"
-            "- [Links](https://example.com) with visible URLs\n"
-            "- ![Image references](path/to/image.png) displayed as paths\n\n"
-            "---\n\n"
-            "*Built for Mac OS X Leopard on PowerPC*\n"
-        )
-        self._render(welcome)
-
-    def _render(self, markdown_text):
-        """Parse and render markdown into the text widget."""
-        segments = self.parser.parse(markdown_text)
-
+        self._select_tab(self._new_tab(None, self._welcome_document()))
+
+    def _welcome_document(self):
+        session = self.session
+        if session.welcome_segments is None:
+            session.welcome_segments = self.parser.parse(self.WELCOME_TEXT)
+        return Document(None, session.welcome_segments, 0, 0)
+
+    def _render_tab(self, tab):
+        """Render tab's document into its (current) text widget."""
+        tab.sections = self._build_sections(tab.document.segments)
+        if tab.fold_state is not None:
+            for section, collapsed in zip(tab.sections, tab.fold_state):
+                section.collapsed = collapsed
+            tab.fold_state = None
+        elif self.fold_on_open.get():
+            for section in tab.sections:
+                section.collapsed = section.level > 0
+
+        self.session.hold_prefetch()
+        tab.images = []
         self.text.config(state=tk.NORMAL)
         self.text.delete('1.0', tk.END)
+        self._insert_sections(tk.END, 0, len(tab.sections))
+        self.text.config(state=tk.DISABLED)
+        self._layout_sections()
+        self._prefetch_links(tab)
+
+    def _prefetch_links(self, tab):
+        """Queue the local markdown files tab links to for prefetching."""
+        paths = []
+        for section in tab.sections:
+            if section.links is None:
+                continue
+            for url in section.links.urls:
+                path = self._resolve_link(url, tab.path)
+                if path is not None and path not in paths and \
+                        is_markdown(path):
+                    paths.append(path)
+                    if len(paths) >= self.PREFETCH_LINKS:
+                        self.session.prefetch(paths)
+                        return
+        self.session.prefetch(paths)
+
+    def _build_sections(self, segments):
+        """Split segments into foldable sections, one per heading.
+
+        Content before the first heading goes into a level-0 section
+        that cannot be collapsed.
+        """
+        section = _Section(0, [])
+        sections = [section]
+        column = 0
+        link = None
+        for segment in segments:
+            text_content, tags = segment
+            if tags and tags[0] in self.HEADING_TAGS:
+                section = _Section(int(tags[0][1]), [segment])
+                sections.append(section)
+                column = 0
+                link = None
+                continue
+            if 'image_icon' in tags:
+                # A one-character slot for the image itself, swapped for
+                # it once it is visible and read
+                section.body.append((' ', ['image_slot']))
+                column += 1
+            section.body.append(segment)
+
+            # The parser emits a link as link_text, ' (', link_url, ')';
+            # index the clickable text under the URL that follows it.
+            if 'link_text' in tags:
+                link = (section.body_lines, column,
+                        column + _char_len(text_content))
+            elif link is not None and 'link_url' in tags:
+                if section.links is None:
+                    section.links = _LinkIndex()
+                section.links.add(link[0], link[1], link[2], text_content)
+                link = None
+
+            newlines = text_content.count('\n')
+            if newlines:
+                section.body_lines += newlines
+                column = _char_len(
+                    text_content[text_content.rindex('\n') + 1:])
+            else:
+                column += _char_len(text_content)
+        return sections
+
+    def _visible_sections(self, start, stop):
+        """Yield (index, section, show_body) for sections in [start, stop)
+        that are not hidden inside a collapsed ancestor."""
+        sections = self.tab.sections
+        hidden_below = None
+        for idx in xrange(start, stop):
+            section = sections[idx]
+            if hidden_below is not None and section.level > hidden_below:
+                continue
+            hidden_below = None
+            if section.collapsed:
+                hidden_below = section.level
+            yield idx, section, not section.collapsed
+
+    def _insert_sections(self, index, start, stop):
+        """Insert the visible part of sections [start, stop) at index.
+
+        Collapsed sections contribute only their heading; their body
+        segments stay in the section list and never reach the widget.
+        """
+        segments = []
+        for idx, section, show_body in self._visible_sections(start, stop):
+            if section.heading:
+                segments.extend(self._heading_segments(section))
+            if show_body:
+                segments.extend(section.body)
+
+        self.text.mark_set('fold_insert', index)
+        self.text.mark_gravity('fold_insert', tk.RIGHT)
+        self._insert_segments('fold_insert', segments)
+        self.text.mark_unset('fold_insert')
+
+    def _heading_segments(self, section):
+        """Return the heading segments prefixed with a fold marker."""
+        tags = section.heading[0][1]
+        if section.collapsed:
+            marker = self.FOLD_CLOSED_MARKER
+        else:
+            marker = self.FOLD_OPEN_MARKER
+        return [(marker, list(tags) + ['fold_marker'])] + section.heading
 
+    def _insert_segments(self, index, segments):
+        """Insert segments at index, batching many segments per Tk call."""
+        pending = self.tab.pending_font_tags
+        args = []
         for text_content, tags in segments:
-            resolved_tags = self._resolve_tags(tags)
-            self.text.insert(tk.END, text_content, tuple(resolved_tags))
+            tags = tuple(self._resolve_tags(tags))
+            if pending:
+                for tag in tags:
+                    if tag in pending:
+                        font = self.fonts[pending.pop(tag)]
+                        self.text.tag_configure(tag, font=font)
+            args.append(text_content)
+            args.append(tags)
+            if len(args) >= 2 * self.INSERT_BATCH:
+                self.text.insert(index, *args)
+                args = []
+        if args:
+            self.text.insert(index, *args)
+
+    def _layout_sections(self):
+        """Recompute the widget line of every visible heading."""
+        tab = self.tab
+        tab.heading_lines = []
+        tab.heading_sections = []
+        tab.link_lines = []
+        tab.link_sections = []
+        line = 1
+        for idx, section, show_body in self._visible_sections(
+                0, len(tab.sections)):
+            if section.heading:
+                tab.heading_lines.append(line)
+                tab.heading_sections.append(idx)
+                line += 1
+            if show_body:
+                if section.links is not None:
+                    tab.link_lines.append(line)
+                    tab.link_sections.append(idx)
+                line += section.body_lines
+        self._schedule_image_check()
+        if not self.highlight_pending:
+            self.highlight_pending = True
+            self.root.after_idle(self._highlight_code_blocks)
+
+    def _highlight_code_blocks(self):
+        """Colour the code blocks that are not highlighted yet.
+
+        Runs once the widget is idle, after the text has been drawn.
+        Blocks already seen (by hash of language and content) are coloured
+        straight from the session cache; the rest go to the highlighter
+        thread.
+        """
+        self.highlight_pending = False
+        text = self.text
+        if text is None or self.tab is None:
+            return
+        index = '1.0'
+        while True:
+            block = text.tag_nextrange('code_block', index)
+            if not block:
+                break
+            start = block[0]
+            tags = text.tag_names(start)
+            # Adjacent blocks run together under code_block; their fence
+            # tags alternate, so that run ends where the block does
+            for tag in tags:
+                if tag.startswith('fence-'):
+                    block = text.tag_nextrange(tag, start)
+                    break
+            start, index = block
+            if 'code_highlighted' in tags:
+                continue
+            text.tag_add('code_highlighted', start, index)
+            if text.tag_nextrange('long_line', start, index):
+                # Minified or generated data: not worth colouring
+                continue
+            language = None
+            for tag in tags:
+                if tag.startswith('lang-'):
+                    language = tag[5:]
+            if not syntax_highlight.supports(language):
+                continue
+            code = text.get(start, index)
+            if isinstance(code, unicode):
+                key = code.encode('utf-8')
+            else:
+                key = code
+            key = hashlib.md5(str(language) + '\0' + key).hexdigest()
+            ranges = self.session.highlights.get(key)
+            if ranges is not None:
+                self._apply_highlight(text, start, ranges)
+                continue
+            # As with images, a tag of its own tracks the block until
+            # the result arrives
+            self._slot_tags += 1
+            tag = 'code%d' % self._slot_tags
+            text.tag_add(tag, start)
+            waiting = self.highlight_waiting.setdefault(key, [])
+            waiting.append((self.tab, tag))
+            if len(waiting) == 1:
+                self.session.highlight((key, language, code),
+                                       self._on_highlighted)
+
+    def _on_highlighted(self, request, ranges):
+        for tab, tag in self.highlight_waiting.pop(request[0], []):
+            if tab.text is None or not tab.text.winfo_exists():
+                continue
+            block = tab.text.tag_ranges(tag)
+            tab.text.tag_delete(tag)
+            if block:
+                self._apply_highlight(tab.text, str(block[0]), ranges)
+
+    def _apply_highlight(self, text, start, ranges):
+        """Tag token ranges relative to start, one Tk call per token."""
+        for token, spans in ranges.items():
+            args = []
+            for span_start, span_end in spans:
+                args.append('%s+%dc' % (start, span_start))
+                args.append('%s+%dc' % (start, span_end))
+            text.tag_add('code_' + token, *args)
+
+    def _on_text_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self._schedule_image_check()
+
+    def _schedule_image_check(self):
+        if not self.image_check_pending:
+            self.image_check_pending = True
+            self.root.after_idle(self._load_visible_images)
+
+    def _load_visible_images(self):
+        """Start loading the images whose slots are in view."""
+        self.image_check_pending = False
+        text = self.text
+        if text is None or self.tab is None:
+            return
+        top = text.index('@0,0')
+        bottom = text.index('@%d,%d lineend' % (text.winfo_width(),
+                                                text.winfo_height()))
+        while True:
+            slot = text.tag_nextrange('image_slot', top, bottom)
+            if not slot:
+                break
+            index = slot[0]
+            top = slot[1]
+            text.tag_remove('image_slot', index)
+            url_range = text.tag_nextrange('link_url', index)
+            if not url_range:
+                continue
+            path = self._resolve_link(text.get(url_range[0], url_range[1]),
+                                      self.tab.path)
+            if path is None or os.path.splitext(path)[1].lower() not in \
+                    self.IMAGE_EXTENSIONS:
+                continue
+            image = self._cached_image(path)
+            if image is not None:
+                self._place_image(self.tab, index, image)
+                continue
+            # A tag of its own follows the slot through edits above it and
+            # disappears if a fold deletes it
+            self._slot_tags += 1
+            tag = 'image%d' % self._slot_tags
+            text.tag_add(tag, index)
+            waiting = self.image_waiting.setdefault(path, [])
+            waiting.append((self.tab, tag))
+            if len(waiting) == 1:
+                self.session.read_image(path, self._on_image_read)
+
+    def _image_key(self, path, mtime):
+        return path, mtime, self._image_width()
+
+    def _image_width(self):
+        return max(64, self.text.winfo_width() - 80)
+
+    def _cached_image(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        return self.session.images.get(self._image_key(path, mtime))
+
+    def _on_image_read(self, path, result):
+        """Decode a read image on the Tk thread and show it in every slot
+        still waiting for it."""
+        image = None
+        if result is not None and self.text is not None:
+            mtime, data = result
+            try:
+                image = tk.PhotoImage(data=data)
+            except tk.TclError:
+                pass
+        if image is not None:
+            width = self._image_width()
+            if image.width() > width:
+                image = image.subsample((image.width() + width - 1) // width)
+            self.session.images.put(self._image_key(path, mtime), image)
+        for tab, tag in self.image_waiting.pop(path, []):
+            if tab.text is None or not tab.text.winfo_exists():
+                continue
+            ranges = tab.text.tag_ranges(tag)
+            tab.text.tag_delete(tag)
+            if ranges and image is not None:
+                self._place_image(tab, str(ranges[0]), image)
+
+    def _place_image(self, tab, index, image):
+        """Replace the slot at index with image and hide the text
+        placeholder around it."""
+        text = tab.text
+        if text.get(index) != ' ':
+            return
+        url_range = text.tag_nextrange('link_url', index)
+        if not url_range:
+            return
+        text.config(state=tk.NORMAL)
+        text.tag_add('image_placeholder', '%s-1c' % index)
+        text.tag_add('image_placeholder', '%s+1c' % index,
+                     '%s+1c' % url_range[1])
+        text.delete(index)
+        text.image_create(index, image=image)
+        text.config(state=tk.DISABLED)
+        tab.images.append(image)
+
+    def _on_heading_click(self, event):
+        tab = self.tab
+        index = event.widget.index('@%d,%d' % (event.x, event.y))
+        line = int(index.split('.')[0])
+        pos = bisect_left(tab.heading_lines, line)
+        if pos < len(tab.heading_lines) and tab.heading_lines[pos] == line:
+            self._toggle_section(tab.heading_sections[pos], pos)
+        return 'break'
+
+    def _toggle_section(self, idx, pos):
+        """Collapse or expand section idx, whose heading is the pos-th
+        visible heading, touching only the lines it owns."""
+        tab = self.tab
+        section = tab.sections[idx]
+        line = tab.heading_lines[pos]
+
+        # The section's visible content runs until the next visible
+        # heading at the same or a higher level.
+        stop = len(tab.sections)
+        end_index = tk.END
+        for later in xrange(pos + 1, len(tab.heading_sections)):
+            other = tab.heading_sections[later]
+            if tab.sections[other].level <= section.level:
+                stop = other
+                end_index = '%d.0' % tab.heading_lines[later]
+                break
 
+        section.collapsed = not section.collapsed
+
+        self.text.config(state=tk.NORMAL)
+        self.text.delete('%d.0' % line, end_index)
+        self._insert_sections('%d.0' % line, idx, stop)
+        self.text.config(state=tk.DISABLED)
+        self._layout_sections()
+
+    def cmd_collapse_all(self):
+        self._set_all_collapsed(True)
+
+    def cmd_expand_all(self):
+        self._set_all_collapsed(False)
+
+    def _set_all_collapsed(self, collapsed):
+        sections = self.tab.sections
+        for section in sections:
+            section.collapsed = collapsed and section.level > 0
+        self.text.config(state=tk.NORMAL)
+        self.text.delete('1.0', tk.END)
+        self._insert_sections(tk.END, 0, len(sections))
         self.text.config(state=tk.DISABLED)
+        self._layout_sections()
 
     def _resolve_tags(self, tags):
         """Resolve tag combinations."""
@@ -339,39 +2365,453 @@ class MarkdownViewer(object):
         resolved.extend(tags)
         return resolved
 
-    def open_file(self, filepath):
-        """Open and render a markdown file."""
+    def open_file(self, filepath, preload=None):
+        """Open a markdown file in a new tab, or switch to its tab.
+
+        If preload is a PreloadThread for this file, its document is used
+        instead of reading and parsing the file again.  A welcome tab is
+        replaced rather than kept alongside.
+        """
+        for tab in self.tabs:
+            if tab.path is not None and \
+                    os.path.abspath(tab.path) == os.path.abspath(filepath):
+                self._select_tab(tab)
+                return
+        welcome = None
+        if self.tab is not None and self.tab.path is None:
+            welcome = self.tab
+        tab = self._new_tab(filepath, preload=preload)
+        if self._select_tab(tab) and welcome is not None:
+            self._discard_tab(welcome)
+
+    def _load_tab(self, tab):
+        """Read and parse tab's file unless that has already happened.
+
+        Returns False, after reporting the error, if the file can't be read.
+        """
+        if tab.document is not None:
+            return True
         try:
-            f = open(filepath, 'r')
             try:
-                content = f.read()
+                if tab.preload is not None:
+                    tab.document = tab.preload.result()
+                    self.session.documents.put(tab.document)
+                else:
+                    tab.document = self.session.load(tab.path)
             finally:
-                f.close()
+                tab.preload = None
+        except IOError, e:
+            self._show_error("Could not open file:\n%s" % str(e))
+            return False
+        except Exception, e:
+            self._show_error("Error reading file:\n%s" % str(e))
+            return False
+        if tab.path is not None:
+            self.session.add_recent(tab.path)
+        return True
+
+    def _new_tab(self, path, document=None, preload=None):
+        tab = _Tab(path, document, preload)
+        self.tabs.append(tab)
+        return tab
+
+    def _select_tab(self, tab):
+        """Show tab, loading and rendering it first if needed.
+
+        Returns False (and drops the tab) if its file can't be loaded.
+        """
+        if not self._load_tab(tab):
+            self._discard_tab(tab)
+            return False
+
+        previous = self.tab
+        if previous is not None and previous is not tab:
+            previous.yview = previous.text.yview()[0]
+            previous.text.pack_forget()
+            previous.text.config(yscrollcommand='')
+
+        self.tab = tab
+        if tab.text is None:
+            self.text = tab.text = self._create_text()
+            tab.pending_font_tags = dict(self.TAG_FONTS)
+            tab.font_zoom = self.zoom
+            self._render_tab(tab)
+        self.text = tab.text
+        if tab.font_zoom != self.zoom:
+            self._apply_fonts(self.fonts)
+
+        self.text.config(yscrollcommand=self._on_text_scroll)
+        self.scrollbar.config(command=self.text.yview)
+        self.text.pack(fill=tk.BOTH, expand=True)
+        self.text.yview_moveto(tab.yview)
+        if self.peer is not None:
+            self._attach_peer()
 
-            self.current_file = filepath
-            filename = os.path.basename(filepath)
-            self.root.title("%s - %s" % (filename, self.APP_NAME))
-            self.file_label.config(text=filepath, fg="#333333")
-            self._render(content)
+        self._tab_clock += 1
+        tab.last_active = self._tab_clock
+        self.find_pos = '1.0'
+        self._update_file_info()
+        self._refresh_tabbar()
+        self._hibernate_tabs()
+        return True
+
+    def _update_file_info(self):
+        """Show the active tab's file in the title, toolbar and status bar."""
+        path = self.tab.path
+        if path is None:
+            self.root.title(self.APP_NAME)
+            self.file_label.config(text="No file loaded",
+                                   fg=self.session.theme['toolbar_text'])
+            self.status_label.config(text="Ready")
+            return
 
-            num_lines = content.count('\n') + 1
-            file_size = os.path.getsize(filepath)
-            if file_size < 1024:
-                size_str = "%d bytes" % file_size
-            else:
-                size_str = "%.1f KB" % (file_size / 1024.0)
-            self.status_label.config(
-                text="%s  |  %d lines  |  %s" % (filename, num_lines, size_str)
-            )
+        document = self.tab.document
+        filename = os.path.basename(path)
+        self.root.title("%s - %s" % (filename, self.APP_NAME))
+        self.file_label.config(text=path, fg=self.session.theme['file_text'])
 
+        file_size = document.file_size
+        if file_size < 1024:
+            size_str = "%d bytes" % file_size
+        else:
+            size_str = "%.1f KB" % (file_size / 1024.0)
+        status = "%s  |  %d lines  |  %s" % (filename, document.num_lines,
+                                             size_str)
+        if document.pages is not None:
+            status += "  |  page %d of %d" % (document.page + 1,
+                                              len(document.pages.pages))
+        if document.long_lines:
+            status += "  |  %d long lines wrapped, formatting skipped" % (
+                document.long_lines)
+        self.status_label.config(text=status)
+
+    def _hibernate_tabs(self):
+        """Free the widgets of the least recently used inactive tabs until
+        the rendered documents fit in TAB_MEMORY_BUDGET."""
+        live = [(tab.last_active, tab) for tab in self.tabs
+                if tab.text is not None and tab is not self.tab]
+        live.sort()
+        used = self.tab.document.file_size
+        for last_active, tab in live:
+            used += tab.document.file_size
+        for last_active, tab in live:
+            if used <= self.TAB_MEMORY_BUDGET:
+                break
+            used -= tab.document.file_size
+            self._hibernate_tab(tab)
+
+    def _hibernate_tab(self, tab):
+        tab.fold_state = [section.collapsed for section in tab.sections]
+        tab.text.destroy()
+        tab.text = None
+        tab.pending_font_tags = None
+        tab.sections = []
+        tab.heading_lines = []
+        tab.heading_sections = []
+        tab.link_lines = []
+        tab.link_sections = []
+        tab.images = []
+        tab.document.segments = _compact_segments(tab.document.segments)
+
+    def _discard_tab(self, tab):
+        """Remove tab and its widgets without selecting another."""
+        self.tabs.remove(tab)
+        if tab.text is not None:
+            tab.text.destroy()
+        if tab.button is not None:
+            tab.button.destroy()
+        if tab is self.tab:
+            self.tab = None
+            self.text = None
+        self._refresh_tabbar()
+
+    def _select_nearest_tab(self, index):
+        """Show the tab at index, or failing that the nearest one whose
+        file still loads; the welcome page if none does."""
+        while self.tabs:
+            if self._select_tab(self.tabs[min(index, len(self.tabs) - 1)]):
+                return
+        self._show_welcome()
+
+    def _refresh_tabbar(self):
+        """Sync the tab bar with self.tabs, hiding it for a single tab."""
+        if len(self.tabs) > 1:
+            if not self.tabbar_visible:
+                self.tabbar.pack(fill=tk.X, side=tk.TOP, after=self.toolbar)
+                self.tabbar_visible = True
+        elif self.tabbar_visible:
+            self.tabbar.pack_forget()
+            self.tabbar_visible = False
+
+        theme = self.session.theme
+        for tab in self.tabs:
+            if tab.path is None:
+                name = "Welcome"
+            else:
+                name = os.path.basename(tab.path)
+            if tab.button is None:
+                tab.button = tk.Label(self.tabbar, padx=12,
+                                      font=self._ui_font(11))
+                tab.button.pack(side=tk.LEFT, fill=tk.Y)
+                tab.button.bind('<Button-1>',
+                                lambda e, tab=tab: self._select_tab(tab))
+            tab.button.config(text=name)
+            if tab is self.tab:
+                tab.button.config(bg=theme['background'],
+                                  fg=theme['tab_text'])
+            else:
+                tab.button.config(bg=theme['tabbar'],
+                                  fg=theme['toolbar_text'])
+
+    def cmd_theme(self):
+        self.session.set_theme(self.theme_name.get())
+
+    def apply_theme(self):
+        """Recolour this window for the session's theme.
+
+        Only widget and tag options change; no document is parsed or
+        inserted again, so switching costs the same however long the
+        open documents are.
+        """
+        theme = self.session.theme
+        self.theme_name.set(self.session.theme_name)
+        self.root.configure(bg=theme['background'])
+        self.toolbar.config(bg=theme['toolbar'])
+        self.file_label.config(bg=theme['toolbar'])
+        self.tabbar.config(bg=theme['tabbar'])
+        self.statusbar.config(bg=theme['statusbar'])
+        self.status_label.config(bg=theme['statusbar'],
+                                 fg=theme['status_text'])
+        self.panes.config(bg=theme['toolbar'])
+        for frame in (self.text_frame, self.split_frame):
+            if frame is not None:
+                frame.config(bg=theme['background'])
+        if self.find_frame is not None:
+            self._color_find_bar()
+        if self.browser is not None:
+            self._color_sidebar()
+        if self.search_dialog is not None and \
+                self.search_dialog.window.winfo_exists():
+            self._color_search_dialog()
+        colors = dict(bg=theme['background'], fg=theme['text'])
+        for tab in self.tabs:
+            if tab.text is not None:
+                tab.text.configure(**colors)
+                self._color_tags(tab.text)
+        if self.peer is not None:
+            # Peers share their tags with the main widget
+            self.peer.configure(**colors)
+        if self.tab is not None:
+            self._update_file_info()
+        self._refresh_tabbar()
+
+    def cmd_toggle_split(self):
+        """Show or hide a second, independently scrolled view of the
+        current document."""
+        if not self.split_view.get():
+            self.panes.forget(self.split_frame)
+            self.peer.destroy()
+            self.peer = None
+            return
+        if tk.TkVersion < 8.5:
+            self.split_view.set(False)
+            self._show_error("Split view needs Tk 8.5 or later.")
+            return
+        if self.split_frame is None:
+            self.split_frame = tk.Frame(self.panes,
+                                        bg=self.session.theme['background'])
+            self.split_scrollbar = tk.Scrollbar(self.split_frame)
+            self.split_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self._attach_peer()
+        self.panes.add(self.split_frame)
+
+    def _attach_peer(self):
+        """Make the split pane a peer of the active tab's text widget."""
+        if self.peer is not None:
+            self.peer.destroy()
+        self.peer = _PeerText(self.split_frame, self.text,
+                              yscrollcommand=self.split_scrollbar.set,
+                              **self._text_options())
+        self._bind_text(self.peer)
+        self.peer.pack(fill=tk.BOTH, expand=True)
+        self.split_scrollbar.config(command=self.peer.yview)
+        self.peer.yview_moveto(self.text.yview()[0])
+
+    def _link_at(self, event):
+        """Return the URL of the link under the pointer, or None."""
+        tab = self.tab
+        if tab is None or not tab.link_lines:
+            return None
+        index = event.widget.index('@%d,%d' % (event.x, event.y))
+        line, column = [int(part) for part in index.split('.')]
+        pos = bisect_right(tab.link_lines, line) - 1
+        if pos < 0:
+            return None
+        section = tab.sections[tab.link_sections[pos]]
+        line -= tab.link_lines[pos]
+        if line >= section.body_lines:
+            return None
+        return section.links.find(line, column)
+
+    def _on_text_click(self, event):
+        url = self._link_at(event)
+        if url is not None:
+            self.follow_link(url)
+            return 'break'
+
+    def _on_text_motion(self, event):
+        over_link = self._link_at(event) is not None
+        if over_link != self.over_link:
+            self.over_link = over_link
+            if over_link:
+                event.widget.config(cursor="hand2")
+            else:
+                event.widget.config(cursor="arrow")
+
+    def follow_link(self, url):
+        """Open a local markdown link in this tab, or a web link in the
+        browser."""
+        url = url.strip().split(' ')[0]
+        if url.startswith('http://') or url.startswith('https://'):
+            import webbrowser
+            webbrowser.open(url)
+            return
+        path = self._resolve_link(url, self.tab.path)
+        if path is None:
+            return
+        if not is_file(path):
+            self.status_label.config(text="Link target not found: %s" % url)
+            return
+        if not is_markdown(path):
+            self.status_label.config(text="Not a markdown file: %s" % url)
+            return
+        document = self._load_for_history(path)
+        if document is None:
+            return
+        tab = self.tab
+        tab.back.append(self._history_entry())
+        del tab.back[:-self.MAX_HISTORY]
+        tab.forward = []
+        self._show_in_tab(document, 0.0, None)
+
+    def _resolve_link(self, url, document_path):
+        """Return the local path a link in the document at document_path
+        refers to, or None for links that only name an anchor or use
+        another scheme."""
+        url = url.strip().split(' ')[0]
+        if '://' in url or url.startswith('mailto:'):
+            return None
+        if isinstance(url, unicode):
+            # %-escapes stand for UTF-8 bytes
+            url = url.encode('utf-8')
+        path = urllib.unquote(url.split('#', 1)[0])
+        if not path:
+            return None
+        if document_path is not None:
+            base = os.path.dirname(os.path.abspath(document_path))
+        else:
+            base = os.getcwd()
+        return os.path.normpath(os.path.join(base, path))
+
+    def cmd_back(self):
+        tab = self.tab
+        if tab is not None and tab.back:
+            self._step_history(tab.back, tab.forward)
+
+    def cmd_forward(self):
+        tab = self.tab
+        if tab is not None and tab.forward:
+            self._step_history(tab.forward, tab.back)
+
+    def cmd_next_page(self):
+        self._step_page(1)
+
+    def cmd_prev_page(self):
+        self._step_page(-1)
+
+    def _step_page(self, step):
+        """Show the next (step 1) or previous (step -1) page of a file
+        shown a page at a time."""
+        tab = self.tab
+        if tab is None or tab.document is None or \
+                tab.document.pages is None:
+            return
+        page = tab.document.page + step
+        if page < 0 or page >= len(tab.document.pages.pages):
+            return
+        document = self._load_for_history(tab.path, page)
+        if document is None:
+            return
+        # Going back a page lands at its end, where the reader left off
+        if step < 0:
+            yview = 1.0
+        else:
+            yview = 0.0
+        self._show_in_tab(document, yview, None)
+
+    def _step_history(self, source, dest):
+        """Go to the newest entry of source, remembering the current
+        place in dest."""
+        entry = source[-1]
+        document = self._load_for_history(entry.path, entry.page)
+        if document is None:
+            return
+        source.pop()
+        dest.append(self._history_entry())
+        self._show_in_tab(document, entry.yview, entry.fold_state)
+
+    def _history_entry(self):
+        tab = self.tab
+        return _HistoryEntry(tab.path, tab.document.page,
+                             self.text.yview()[0],
+                             [section.collapsed for section in tab.sections])
+
+    def _load_for_history(self, path, page=0):
+        """Return the document for a history step, from the session cache
+        when possible; None after reporting an error."""
+        if path is None:
+            return self._welcome_document()
+        try:
+            if page:
+                return load_document(path, self.parser, page)
+            return self.session.load(path)
         except IOError, e:
-            tkMessageBox.showerror("Error",
-                                   "Could not open file:\n%s" % str(e))
+            self._show_error("Could not open file:\n%s" % str(e))
         except Exception, e:
-            tkMessageBox.showerror("Error",
-                                   "Error reading file:\n%s" % str(e))
+            self._show_error("Error reading file:\n%s" % str(e))
+        return None
+
+    def _show_in_tab(self, document, yview, fold_state):
+        """Replace the active tab's document, restoring scroll and folds."""
+        tab = self.tab
+        tab.path = document.path
+        tab.document = document
+        tab.fold_state = fold_state
+        self._render_tab(tab)
+        self.text.yview_moveto(yview)
+        self.find_pos = '1.0'
+        if tab.path is not None:
+            self.session.add_recent(tab.path)
+        self._update_file_info()
+        self._refresh_tabbar()
+
+    def cmd_next_tab(self):
+        self._cycle_tab(1)
+
+    def cmd_prev_tab(self):
+        self._cycle_tab(-1)
+
+    def _cycle_tab(self, step):
+        if len(self.tabs) > 1:
+            idx = self.tabs.index(self.tab)
+            self._select_tab(self.tabs[(idx + step) % len(self.tabs)])
+
+    def _show_error(self, message):
+        import tkMessageBox
+        tkMessageBox.showerror("Error", message)
 
     def cmd_open(self):
+        import tkFileDialog
         filepath = tkFileDialog.askopenfilename(
             title="Open Markdown File",
             filetypes=[
@@ -379,18 +2819,98 @@ class MarkdownViewer(object):
                 ("Markdown files", "*.markdown"),
                 ("Markdown files", "*.mdown"),
                 ("Text files", "*.txt"),
+                ("Compressed Markdown", "*.gz"),
+                ("Compressed Markdown", "*.bz2"),
+                ("Documentation bundles", "*.zip"),
                 ("All files", "*.*"),
             ]
         )
-        if filepath:
+        if filepath and is_archive(filepath):
+            self.show_folder(filepath)
+        elif filepath:
             self.open_file(filepath)
 
+    def cmd_open_folder(self):
+        import tkFileDialog
+        path = tkFileDialog.askdirectory(title="Open Folder",
+                                         mustexist=True)
+        if path:
+            self.show_folder(path)
+
+    def show_folder(self, path):
+        """Show the tree of path in the folder sidebar."""
+        if self.browser is None:
+            self.browser = FolderBrowser(self.root,
+                                         self.session.directory_scanner(),
+                                         self.open_file, self._ui_font(11))
+            self._color_sidebar()
+        self.browser.set_root(os.path.abspath(path))
+        self.show_sidebar.set(True)
+        self.cmd_toggle_sidebar()
+
+    def _color_sidebar(self):
+        theme = self.session.theme
+        self.browser.frame.config(bg=theme['sidebar'])
+        self.browser.listbox.config(bg=theme['sidebar'],
+                                    fg=theme['sidebar_text'])
+
+    def cmd_toggle_sidebar(self):
+        if not self.show_sidebar.get():
+            if self.browser is not None:
+                self.browser.frame.pack_forget()
+        elif self.browser is None:
+            self.show_sidebar.set(False)
+            self.cmd_open_folder()
+        else:
+            self.browser.frame.pack(side=tk.LEFT, fill=tk.Y,
+                                    before=self.panes)
+
+    def open_files_from_instance(self, paths):
+        """Open paths handed over by a later launch and raise the window."""
+        for path in paths:
+            if is_archive(path):
+                self.show_folder(path)
+            elif is_file(path):
+                self.open_file(path)
+        self.root.deiconify()
+        self.root.lift()
+
     def cmd_reload(self):
-        if self.current_file:
-            self.open_file(self.current_file)
+        tab = self.tab
+        if tab is None or tab.path is None:
+            return
+        try:
+            document = load_document(tab.path, self.parser,
+                                     tab.document.page)
+        except IOError, e:
+            self._show_error("Could not open file:\n%s" % str(e))
+            return
+        except Exception, e:
+            self._show_error("Error reading file:\n%s" % str(e))
+            return
+        self.session.documents.put(document)
+        yview = self.text.yview()[0]
+        tab.document = document
+        self._render_tab(tab)
+        self.text.yview_moveto(yview)
+        self._update_file_info()
 
     def cmd_close(self):
-        self.root.destroy()
+        """Close the current tab, or the window when it is the last one."""
+        if len(self.tabs) > 1:
+            idx = self.tabs.index(self.tab)
+            self._discard_tab(self.tab)
+            self._select_nearest_tab(idx)
+        else:
+            self.cmd_close_window()
+
+    def cmd_new_window(self):
+        self.session.new_window()
+
+    def cmd_close_window(self):
+        while self.tabs:
+            self._discard_tab(self.tabs[-1])
+        self.session.close_window(self)
 
     def cmd_copy(self):
         try:
@@ -406,32 +2926,80 @@ class MarkdownViewer(object):
         self.text.config(state=tk.DISABLED)
 
     def cmd_zoom_in(self):
-        self._adjust_zoom(2)
+        self._adjust_zoom(self.ZOOM_STEP)
 
     def cmd_zoom_out(self):
-        self._adjust_zoom(-2)
+        self._adjust_zoom(-self.ZOOM_STEP)
 
     def cmd_zoom_reset(self):
-        base = self.base_size
-        defaults = {
-            'normal': base, 'bold': base, 'italic': base,
-            'bold_italic': base,
-            'h1': base + 13, 'h2': base + 9, 'h3': base + 5,
-            'h4': base + 3, 'h5': base + 1, 'h6': base,
-            'code': base - 1, 'code_block': base - 1,
-        }
-        for name, size in defaults.items():
-            if name in self.fonts:
-                self.fonts[name].configure(size=size)
+        self._set_zoom(0)
 
     def _adjust_zoom(self, delta):
-        for font in self.fonts.values():
-            current = font.cget("size")
-            new_size = max(8, current + delta)
-            font.configure(size=new_size)
+        session = self.session
+        largest = session.BASE_FONT_SIZE + max(
+            [spec[1] for spec in session.FONT_SPECS.values()])
+        if largest + self.zoom + delta < session.MIN_FONT_SIZE:
+            return
+        self._set_zoom(self.zoom + delta)
+
+    def _set_zoom(self, zoom):
+        """Switch every tag to the font set for a zoom level in one pass."""
+        if zoom == self.zoom:
+            return
+        self.zoom = zoom
+        self.fonts = self.session.font_set(zoom)
+        self._apply_fonts(self.fonts)
+
+    def _build_find_bar(self):
+        """Create the find bar widgets; deferred until the first Cmd+F."""
+        self.find_frame = tk.Frame(self.root, height=30)
+        self.find_frame.pack_propagate(False)
+
+        self.find_label = tk.Label(self.find_frame, text="Find:",
+                                   font=self._ui_font(11))
+        self.find_label.pack(side=tk.LEFT, padx=(10, 4))
+
+        self.find_entry = tk.Entry(self.find_frame, width=30,
+                                    font=self._ui_font(11),
+                                    highlightthickness=1,
+                                    relief=tk.SOLID)
+        self.find_entry.pack(side=tk.LEFT, padx=2, pady=4)
+        self.find_entry.bind('<Return>', lambda e: self._do_find())
+        self.find_entry.bind('<Escape>', lambda e: self._hide_find_bar())
+
+        find_btn = tk.Button(self.find_frame, text="Next",
+                             command=self._do_find,
+                             font=self._ui_font(10))
+        find_btn.pack(side=tk.LEFT, padx=4)
+
+        find_prev_btn = tk.Button(self.find_frame, text="Prev",
+                                   command=self._do_find_prev,
+                                   font=self._ui_font(10))
+        find_prev_btn.pack(side=tk.LEFT, padx=2)
+
+        self.find_count_label = tk.Label(self.find_frame, text="",
+                                          font=self._ui_font(10))
+        self.find_count_label.pack(side=tk.LEFT, padx=8)
+
+        self.find_close_btn = tk.Button(self.find_frame, text="\xC3\x97",
+                                        command=self._hide_find_bar,
+                                        font=self._ui_font(11),
+                                        relief=tk.FLAT)
+        self.find_close_btn.pack(side=tk.RIGHT, padx=6)
+        self._color_find_bar()
+
+    def _color_find_bar(self):
+        theme = self.session.theme
+        self.find_frame.config(bg=theme['findbar'])
+        self.find_label.config(bg=theme['findbar'], fg=theme['findbar_text'])
+        self.find_count_label.config(bg=theme['findbar'],
+                                     fg=theme['toolbar_text'])
+        self.find_close_btn.config(bg=theme['findbar'])
 
     def cmd_find(self):
         """Show the find bar and focus the entry."""
+        if self.find_frame is None:
+            self._build_find_bar()
         if not self.find_visible:
             self.find_frame.pack(fill=tk.X, side=tk.BOTTOM,
                                  before=self.statusbar)
@@ -439,6 +3007,109 @@ class MarkdownViewer(object):
         self.find_entry.focus_set()
         self.find_entry.selection_range(0, tk.END)
 
+    def cmd_search_folder(self):
+        """Search the sidebar's folder, asking for one if none is open."""
+        if self.search_dialog is not None and \
+                self.search_dialog.window.winfo_exists():
+            self.search_dialog.window.lift()
+            self.search_dialog.entry.focus_set()
+            return
+        if self.browser is not None:
+            folder = self.browser.root_path
+        else:
+            import tkFileDialog
+            folder = tkFileDialog.askdirectory(title="Search Folder",
+                                               mustexist=True)
+            if not folder:
+                return
+            folder = os.path.abspath(folder)
+        self.search_dialog = SearchDialog(self.root,
+                                          self.session.search_index(folder),
+                                          self.open_search_hit,
+                                          self._ui_font(11))
+        self._color_search_dialog()
+
+    def _color_search_dialog(self):
+        theme = self.session.theme
+        dialog = self.search_dialog
+        dialog.window.config(bg=theme['background'])
+        dialog.entry.config(bg=theme['background'], fg=theme['text'],
+                            insertbackground=theme['text'])
+        dialog.results.config(bg=theme['sidebar'], fg=theme['sidebar_text'])
+        dialog.status.config(bg=theme['background'],
+                             fg=theme['status_text'])
+
+    def open_search_hit(self, hit):
+        """Open the file of a folder search hit and show the match."""
+        self.open_file(hit.path)
+        if self.tab is None or self.tab.path is None or \
+                os.path.abspath(self.tab.path) != os.path.abspath(hit.path):
+            return
+        if self.tab.document.pages is None:
+            self.reveal_offset(hit.offset, hit.length)
+            return
+        # The offset counts from the top of the whole file; find the term
+        # again from its line on the page holding that line
+        page = self.tab.document.pages.page_of_line(hit.line)
+        if page != self.tab.document.page:
+            document = self._load_for_history(hit.path, page)
+            if document is None:
+                return
+            self._show_in_tab(document, 0.0, None)
+        document = self.tab.document
+        starts = document.line_starts
+        first = bisect_right(starts, hit.line) - 1
+        if first >= 0:
+            # Back to the first segment of the block holding the line
+            first = bisect_left(starts, starts[first])
+        else:
+            first = 0
+        offset = 0
+        pieces = []
+        for index, (text_content, tags) in enumerate(document.segments):
+            if isinstance(text_content, str):
+                text_content = text_content.decode('utf-8', 'replace')
+            if index < first:
+                offset += len(text_content)
+            else:
+                pieces.append(text_content)
+        found = u''.join(pieces).lower().find(hit.term)
+        if found >= 0:
+            self.reveal_offset(offset + found, hit.length)
+
+    def reveal_offset(self, offset, length):
+        """Scroll to and mark length characters at offset in the active
+        document's plain text, unfolding sections if it is hidden."""
+        text = ''.join([segment[0] for segment in self.tab.document.segments])
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        line = text.count(u'\n', 0, offset) + 1
+        column = offset - (text.rfind(u'\n', 0, offset) + 1)
+        # Each image on the line has a one-character slot before it
+        line_start = offset - column
+        position = 0
+        for text_content, tags in self.tab.document.segments:
+            if position >= offset:
+                break
+            if 'image_icon' in tags and position >= line_start:
+                column += 1
+            if isinstance(text_content, str):
+                text_content = text_content.decode('utf-8', 'replace')
+            position += len(text_content)
+        for section in self.tab.sections:
+            if section.collapsed:
+                self._set_all_collapsed(False)
+                break
+        # Heading lines start with a fold marker the plain text lacks
+        pos = bisect_left(self.tab.heading_lines, line)
+        if pos < len(self.tab.heading_lines) and \
+                self.tab.heading_lines[pos] == line:
+            column += len(self.FOLD_OPEN_MARKER)
+        index = '%d.%d' % (line, column)
+        self.text.tag_remove('find_current', '1.0', tk.END)
+        self.text.tag_add('find_current', index, '%s+%dc' % (index, length))
+        self.text.see(index)
+
     def _hide_find_bar(self):
         """Hide the find bar and clear highlights."""
         if self.find_visible:
@@ -540,15 +3211,107 @@ class MarkdownViewer(object):
             self.find_count_label.config(text="%d found" % total)
 
 
-def main():
-    root = tk.Tk()
+def build_indexes(folders):
+    """Bring the saved search index of each folder up to date without a
+    window, parsing in a process pool where multiprocessing is available,
+    and print a line for each.  Returns the exit status (1 if a folder
+    couldn't be indexed)."""
+    status = 0
+    for folder in folders:
+        folder = os.path.abspath(folder)
+        if not os.path.isdir(folder):
+            print >> sys.stderr, "%s: not a folder" % folder
+            status = 1
+            continue
+        started = time.time()
+        index = FolderIndex(folder, _index_path(folder))
+        index.load()
+        updated = index.update()
+        if updated:
+            index.save()
+        print "%s: %d files indexed (%d updated) in %.1f s" % (
+            folder, len(index.mtimes), updated, time.time() - started)
+    return status
 
-    filepath = None
-    if len(sys.argv) > 1:
-        filepath = sys.argv[1]
 
-    app = MarkdownViewer(root, filepath)
-    root.mainloop()
+def main():
+    option_parser = optparse.OptionParser(
+        usage="%prog [options] [file.md ...]")
+    option_parser.add_option('--profile-startup', action='store_true',
+                             default=False,
+                             help="print the time spent in each startup phase")
+    option_parser.add_option('--no-preload', action='store_false',
+                             dest='preload', default=True,
+                             help="read the file only after the window is "
+                                  "built (to compare with the default)")
+    option_parser.add_option('--prefetch-share', type='float',
+                             default=ViewerSession.PREFETCH_SHARE,
+                             metavar='FRACTION',
+                             help="share of one CPU used to parse linked "
+                                  "and recent files in the background; "
+                                  "0 disables prefetching (default %default)")
+    option_parser.add_option('--check-links', action='store_true',
+                             default=False,
+                             help="check the links and images in the given "
+                                  "files and folders, print a report and "
+                                  "exit without opening a window")
+    option_parser.add_option('--check-anchors', action='store_true',
+                             default=False,
+                             help="with --check-links, also check #anchors "
+                                  "against the target's headings")
+    option_parser.add_option('--build-index', action='store_true',
+                             default=False,
+                             help="update the folder search index of the "
+                                  "given folders and exit without opening "
+                                  "a window")
+    option_parser.add_option('--single-instance', action='store_true',
+                             default=False,
+                             help="open the file in an already running "
+                                  "viewer if there is one")
+    # Finder passes a -psn_* process serial number when launching the app
+    argv = [arg for arg in sys.argv[1:] if not arg.startswith('-psn_')]
+    options, args = option_parser.parse_args(argv)
+
+    if options.check_links:
+        import link_checker
+        sys.exit(link_checker.print_report(
+            link_checker.check(args or [os.getcwd()],
+                               anchors=options.check_anchors)))
+    if options.build_index:
+        sys.exit(build_indexes(args or [os.getcwd()]))
+
+    # Claim the instance socket before the slow Tk setup, so that a
+    # second launch in the meantime finds this viewer
+    server = None
+    if options.single_instance:
+        server = InstanceServer()
+        if not server.bind():
+            if send_to_running_instance(args):
+                return
+            if not (remove_stale_socket() and server.bind()):
+                server = None
+
+    # Read and parse the first file while Tk, fonts and widgets are set up
+    parser = MarkdownParser()
+    preload = None
+    if options.preload and args and os.path.isfile(args[0]) and \
+            not is_archive(args[0]):
+        preload = PreloadThread(args[0], parser)
+        preload.start()
+
+    root = tk.Tk()
+    session = ViewerSession(root, parser,
+                            prefetch_share=options.prefetch_share)
+    MarkdownViewer(root, args, profile_startup=options.profile_startup,
+                   session=session, preload=preload)
+
+    if server is not None:
+        server.attach(root, session.open_files)
+    try:
+        root.mainloop()
+    finally:
+        if server is not None:
+            server.close()
 
 
 if __name__ == '__main__':